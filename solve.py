@@ -1,142 +1,795 @@
 # v20251023
 
+import os
+import sys
+import json
+import argparse
 import random
 import datetime
+import functools
+import hashlib
+import time
+import pickle
+import zipfile
+from dataclasses import dataclass
+import numpy as np
 from openpyxl import load_workbook
 from openpyxl.styles import Font, PatternFill
 from ortools.sat.python import cp_model
 
 #### PART1 ####
 # === 1.1 Setup & Data Loading ===
-print("➡️  Solving...")
+parser = argparse.ArgumentParser(description="ED roster solver")
+parser.add_argument("input", nargs="?", default="Roster_input.xlsx",
+                    help="Roster_input.xlsx, a .json input, or a directory of CSV/Parquet tables")
+parser.add_argument("--sheet", default="Sheet1", help="worksheet name (Excel input)")
+parser.add_argument("--export-input", metavar="PATH",
+                    help="write the parsed input as .json (or a CSV bundle directory) and exit")
+parser.add_argument("--no-precheck", action="store_true",
+                    help="skip the capacity pre-check and go straight to the solver")
+parser.add_argument("--model-stats", action="store_true",
+                    help="print model size and build time per rule family before solving")
+parser.add_argument("--implied-constraints", action="store_true",
+                    help="add redundant aggregate constraints (work days, weekend OFF capacity, "
+                         "Nights vs OFF / A days) that the rules already imply")
+parser.add_argument("--symmetry-breaking", action="store_true",
+                    help="order interchangeable staff (same rank, quotas, limits, last month and "
+                         "no requests) lexicographically")
+parser.add_argument("--sequence-mode", choices=("reified", "automaton"), default="reified",
+                    help="encode the A–N–O, Sat→Sun PM and PA/PAN/PPP cap rules as reified "
+                         "constraints (default) or as one automaton per staff row")
+parser.add_argument("--time-limit", type=float, metavar="SECONDS",
+                    help="solver time limit (overrides cell F3; default 300)")
+parser.add_argument("--workers", type=int, metavar="N",
+                    help="parallel solver workers (overrides cell G3; default: one per CPU core)")
+parser.add_argument("--seed", type=int, metavar="N",
+                    help="solver random seed (overrides cell H3; default: a random one, reported in Output1)")
+parser.add_argument("--relative-gap", type=float, metavar="GAP",
+                    help="stop once the penalty is within this fraction of the best bound (overrides F4)")
+parser.add_argument("--preset", metavar="NAME",
+                    help="named solver parameter preset (overrides G4): default, quick, feasibility, thorough")
+parser.add_argument("--solver-log", action="store_true",
+                    help="print the CP-SAT search log")
+parser.add_argument("--hint", metavar="PATH",
+                    help="warm-start from a roster grid: a previous Roster_Output1 (.xlsx / .json) or a "
+                         "draft typed into a copy of the input sheet")
+parser.add_argument("--hint-repair", action="store_true",
+                    help="with --hint: if the hinted cells break a hard rule, start from the closest roster "
+                         "that does not (changes the fewest hinted cells)")
+parser.add_argument("--two-phase", action="store_true",
+                    help="with penalties on (D3 = Y): find a valid roster without penalties first, then "
+                         "minimise the penalties from it, in one run")
+parser.add_argument("--phase1-time", type=float, default=60.0, metavar="SEC",
+                    help="time budget of the first phase of --two-phase (default: 60)")
+parser.add_argument("--diagnose", action="store_true",
+                    help="if there is no roster, name a minimal set of conflicting rules (per family, "
+                         "split by day or staff) instead of solving")
+parser.add_argument("--snapshot", metavar="PATH",
+                    help="write each improving roster to PATH while solving: .xlsx a provisional "
+                         "Output1, .json Output1 as JSON with the objective and its PA/PAN/PPP breakdown")
+parser.add_argument("--snapshot-every", type=float, default=30.0, metavar="SEC",
+                    help="write a snapshot at most once per SEC seconds (default: 30)")
+parser.add_argument("--rules", metavar="PATH",
+                    help="rule spec (.json, or .yaml with PyYAML) replacing the built-in DEFAULT_RULES")
+parser.add_argument("--export-rules", metavar="PATH",
+                    help="write the built-in rule spec as JSON (a starting point for --rules) and exit")
+args = parser.parse_args()
+
+INPUT_ROSTER = args.input
+SHEET_NAME   = args.sheet
+INPUT_IS_EXCEL = INPUT_ROSTER.lower().endswith((".xlsx", ".xlsm"))
+OUTPUT_FILE  = "Roster_Output1.xlsx" if INPUT_IS_EXCEL else "Roster_Output1.json"
+SEQUENCE_MODE = args.sequence_mode   # "reified" or "automaton" (see 2.x Sequence automaton)
+if args.diagnose:
+    SEQUENCE_MODE = "reified"        # an automaton cannot be switched off by a guard literal
+
+# Parsed-input cache (set ROSTER_CACHE_DIR = None to always re-parse)
+ROSTER_CACHE_DIR  = ".roster_cache"
+ROSTER_CACHE_KEEP = 16   # most recent entries kept
+PARSER_VERSION    = 3    # bump whenever load_roster_input() changes what it reads
+
+ROW_START  = 6    # first staff row
+PA_CAP_ROW = 68   # daily PA caps (counted on the A day)
+
+# Quota columns E–O, in sheet order (init_hr in O is a formula; we read its cached value)
+QUOTA_KEYS = ("N*", "N", "N3", "Z", "Nspacing", "SUN-Off", "WE-Off", "SUN P", "min_pa", "max_pa", "init_hr")
+
+# Solver parameters, next to the D3 / D4 toggles: setting -> (row, col); blank = default
+SOLVER_CELLS = {
+    "time_limit":   (3, 6),   # F3, seconds
+    "workers":      (3, 7),   # G3
+    "seed":         (3, 8),   # H3
+    "relative_gap": (4, 6),   # F4
+    "preset":       (4, 7),   # G4, a SOLVER_PRESETS name
+}
 
-INPUT_ROSTER = "Roster_input.xlsx"
-SHEET_NAME   = "Sheet1"
-OUTPUT_FILE  = "Roster_Output1.xlsx"
+# Rank-mix rows below 'Manpower': group -> offset of its A≥ row (then A≤, P≥, P≤)
+RANK_MIX_ROWS = {
+    "senior": 4,   # Sen(A)≥ ... Sen(P)≤
+    "junior": 8,   # JA / JP
+    "conac":  12,  # CON+AC
+    "ac":     16,  # AC only
+    "ht":     20,  # HT (HT1+HT2)
+    "bt":     24,  # BT
+    "e":      28,  # E
+}
 
-wb_roster = load_workbook(INPUT_ROSTER)
-ws_roster = wb_roster[SHEET_NAME]
 
-# Month
-month = ws_roster.cell(row=1, column=3).value
+# === Sheet landmarks ===
+# name -> (first row, last row, last col, match on substring?)
+# Found in one sweep per worksheet by sheet_anchors(); shared by the input,
+# Output1, Output2 and the v0.xlsx template.
+SHEET_ANCHORS = {
+    "START":          (1, 1,   None, False),   # day block starts one column right
+    "MANPOWER":       (1, 99,  None, False),   # coverage / rank-mix block
+    "OUTPUT":         (1, 10,  None, False),   # Output1 staff statistics
+    "SPECIAL DUTIES": (4, 4,   None, False),   # special duty tiers (Part 4)
+    "NAME OF":        (1, 30,  100,  True),    # departmental template (Part 5)
+}
+_ANCHOR_LAST_ROW = max(v[1] for v in SHEET_ANCHORS.values())
 
+def norm_text(v: object) -> str:
+    s = str(v or "")
+    return " ".join(s.split()).upper()
 
-# === 1.2 Staff & quotas ===
-ROW_START = 6
-staff, ranks, quotas = [], [], {}
+def build_anchor_index(rows):
+    """Single row-major sweep over cell values -> {landmark: (row, col)} (1-based, first hit)."""
+    index = {}
+    for r, row in enumerate(rows, start=1):
+        if r > _ANCHOR_LAST_ROW or len(index) == len(SHEET_ANCHORS):
+            break
+        for c, v in enumerate(row, start=1):
+            if not isinstance(v, str):
+                continue
+            txt = norm_text(v)
+            for name, (r0, r1, c1, contains) in SHEET_ANCHORS.items():
+                if name in index or not (r0 <= r <= r1) or (c1 and c > c1):
+                    continue
+                if (name in txt) if contains else (txt == name):
+                    index[name] = (r, c)
+    return index
 
-# open a second copy of the roster for formula results
-wb_roster_values = load_workbook(INPUT_ROSTER, data_only=True)
-ws_values        = wb_roster_values[SHEET_NAME]
+def sheet_anchors(ws):
+    """Anchor index of an openpyxl worksheet (reads only the rows landmarks can be in)."""
+    last = min(ws.max_row, _ANCHOR_LAST_ROW)   # iter_rows past max_row would create cells
+    return build_anchor_index(ws.iter_rows(min_row=1, max_row=last, values_only=True))
 
-r = ROW_START
-while True:
-    name = ws_roster.cell(row=r, column=4).value  # D
-    if not name:
-        break
-    name = str(name).strip()
-    staff.append(name)
-    ranks.append(str(ws_roster.cell(row=r, column=3).value or "").strip())  # C
-
-    # raw quotas E–O (static numbers, no formulas here)
-    raw = [ws_roster.cell(row=r, column=c).value for c in range(5, 15)]
-    quotas[name] = {
-        "N*":      int(raw[0] or 0),
-        "N":        int(raw[1] or 0),
-        "N3":       int(raw[2] or 0),
-        "Z":        int(raw[3] or 0),
-        "Nspacing": float(raw[4] or 4),
-        "SUN-Off":  int(raw[5]) if raw[5] is not None else None,
-        "WE-Off":   int(raw[6]) if raw[6] is not None else None,
-        "SUN P":    int(raw[7]) if raw[7] is not None else None,
-        "min_pa":   float(raw[8] or 0),
-        "max_pa":   float(raw[9] or 1.5),
+def find_anchor(index, name):
+    if name not in index:
+        r0, r1, c1, _ = SHEET_ANCHORS[name]
+        where = f"row {r0}" if r0 == r1 else f"rows {r0}–{r1}"
+        raise RuntimeError(f'❌ Could not find "{name.title()}" ({where}).')
+    return index[name]
+
+
+def strip_arrow(val):
+    """Return (core, has_arrow). core has any trailing ↗ removed."""
+    s = str(val or "").strip()
+    if s.endswith("↗"):
+        return s[:-1].strip(), True
+    return s, False
+
+
+@dataclass
+class RosterInput:
+    """Everything the solver reads from the input sheet, parsed in a single pass.
+
+    Per-day tables are NumPy arrays indexed by day offset from START_COL:
+      cov[d]            -> (AM, PM, Night) coverage
+      rank_mix[g][:, d] -> (minA, maxA, minP, maxP) for group g (see RANK_MIX_ROWS)
+    quota_arr[s, k] holds QUOTA_KEYS[k] for staff s (NaN = blank).
+    Duty requests are kept as a compact grid: req_grid[s, d] indexes req_codes (-1 = empty).
+    """
+    month: object
+    staff: list
+    ranks: list
+    quota_arr: np.ndarray
+    start_col: int
+    manpower_row: int
+    anchors: dict              # landmark -> (row, col), see SHEET_ANCHORS
+    special: list
+    dates: list
+    weekdays: list
+    cov: np.ndarray
+    rank_mix: dict
+    req_codes: list
+    req_grid: np.ndarray
+    prev_last7_raw: list
+    hr_bounds: list            # per staff (min_or_None, max_or_None)
+    pattern_caps: np.ndarray   # per staff (PA, PAN, PPP) caps, 99 = blank
+    daily_pa_cap: np.ndarray   # per day, NUM_STAFF = blank
+    settings: dict             # global cells (J2:N3, I2, O2, D3)
+
+    @property
+    def quotas(self):
+        out = {}
+        for s, name in enumerate(self.staff):
+            q = {}
+            for k, key in enumerate(QUOTA_KEYS):
+                v = self.quota_arr[s, k]
+                q[key] = None if np.isnan(v) else v
+            for key in ("N*", "N", "N3", "Z"):
+                q[key] = int(q[key] or 0)
+            for key in ("SUN-Off", "WE-Off", "SUN P"):
+                q[key] = int(q[key]) if q[key] is not None else None
+            q["Nspacing"] = float(q["Nspacing"] or 4)
+            q["min_pa"]   = float(q["min_pa"] or 0)
+            q["max_pa"]   = float(q["max_pa"] or 1.5)
+            q["init_hr"]  = float(q["init_hr"] or 0)
+            out[name] = q
+        return out
+
+    @property
+    def fixed_raw(self):
+        return {(int(s), int(d)): self.req_codes[self.req_grid[s, d]]
+                for s, d in zip(*np.nonzero(self.req_grid >= 0))}
+
+    @property
+    def fixed_clean(self):
+        return {k: v.rstrip("↗").strip() for k, v in self.fixed_raw.items()}
+
+    @property
+    def day_type(self):
+        return ["WE" if wd in ("SAT", "SUN") or tag.startswith(("SH", "PH")) else "WD"
+                for tag, wd in zip(self.special, self.weekdays)]
+
+    @property
+    def prev_last7(self):
+        # clean duty codes; empty -> Off
+        return [[strip_arrow(v)[0] or "O" for v in row] for row in self.prev_last7_raw]
+
+    @property
+    def prev_last7_arrow(self):
+        return [[strip_arrow(v)[1] for v in row] for row in self.prev_last7_raw]
+
+
+def load_roster_input(path, sheet_name=SHEET_NAME):
+    """Read the roster sheet once (values only, bulk) into a RosterInput."""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    rows = [list(r) for r in wb[sheet_name].iter_rows(values_only=True)]
+    wb.close()
+    width = max((len(r) for r in rows), default=0)
+    for r in rows:
+        r.extend([None] * (width - len(r)))
+
+    def cell(row, col):
+        # 1-based, like ws.cell(); outside the used range reads as blank
+        if 1 <= row <= len(rows) and 1 <= col <= width:
+            return rows[row - 1][col - 1]
+        return None
+
+    def _iv(v, dflt):
+        try: return int(v) if v not in (None, "") else dflt
+        except (TypeError, ValueError): return dflt
+
+    # 1.2 Staff & quotas (C = rank, D = name, E–O quotas, P/Q hour range, R–T pattern caps)
+    staff, ranks, quota_rows, hr_bounds, caps = [], [], [], [], []
+    r = ROW_START
+    while cell(r, 4):
+        staff.append(str(cell(r, 4)).strip())
+        ranks.append(str(cell(r, 3) or "").strip())
+        quota_rows.append([np.nan if v in (None, "") else float(v) for v in (cell(r, c) for c in range(5, 16))])
+
+        lb = None if cell(r, 16) in (None, "") else int(cell(r, 16))
+        ub = None if cell(r, 17) in (None, "") else int(cell(r, 17))
+        # If someone accidentally types lb>ub, swap to be safe
+        if (lb is not None) and (ub is not None) and (lb > ub):
+            lb, ub = ub, lb
+        hr_bounds.append((lb, ub))
+
+        caps.append([_iv(cell(r, c), 99) for c in (18, 19, 20)])
+        r += 1
+    num_staff = len(staff)
+
+    # 1.3 Locate Day Block / Manpower block
+    anchors = build_anchor_index(rows)
+    start_col = find_anchor(anchors, "START")[1] + 1
+    if "MANPOWER" not in anchors:
+        raise ValueError("❌ Could not locate 'Manpower' cell in Roster sheet.")
+    manpower_row = anchors["MANPOWER"][0]
+
+    # 1.4 Read days
+    special, dates, weekdays = [], [], []
+    col = start_col
+    while cell(3, col) is not None:
+        date = cell(3, col)
+        special.append(str(cell(1, col) or "").upper().strip())
+        dates.append(date.day if isinstance(date, datetime.datetime) else int(date))
+        weekdays.append(str(cell(4, col) or "").upper().strip())
+        col += 1
+    num_days = len(dates)
+    day_cols = range(start_col, start_col + num_days)
+
+    # 1.5 Per-day coverage & rank-mix rows from the 'Manpower' block
+    cov = np.array([[int(cell(manpower_row + k, c) or 0) for k in (1, 2, 3)] for c in day_cols],
+                   dtype=np.int64).reshape(num_days, 3)
+    rank_mix = {}
+    for group, off in RANK_MIX_ROWS.items():
+        if group == "senior":
+            rd = lambda v, dflt: int(v or dflt)   # senior rows: 0/blank -> default
+        else:
+            rd = _iv
+        rank_mix[group] = np.array(
+            [[rd(cell(manpower_row + off + k, c), dflt) for c in day_cols]
+             for k, dflt in enumerate((0, 99, 0, 99))], dtype=np.int64).reshape(4, num_days)
+    daily_pa_cap = np.array([_iv(cell(PA_CAP_ROW, c), num_staff) for c in day_cols], dtype=np.int64)
+
+    # 1.7 Duty requests -> compact code grid
+    req_codes, code_idx = [], {}
+    req_grid = np.full((num_staff, num_days), -1, dtype=np.int16)
+    for s in range(num_staff):
+        for d in range(num_days):
+            v = cell(ROW_START + s, start_col + d)
+            if isinstance(v, str) and v.strip():
+                v = v.strip()
+                if v not in code_idx:
+                    code_idx[v] = len(req_codes)
+                    req_codes.append(v)
+                req_grid[s, d] = code_idx[v]
+
+    # Last 7 days of LAST month (reference only): START_COL-8 ... START_COL-2
+    if start_col <= 8:
+        raise RuntimeError("Not enough columns before START to read last 7 days (shifted left).")
+    prev_last7_raw = [[cell(ROW_START + s, c) for c in range(start_col - 8, start_col - 1)]
+                      for s in range(num_staff)]
+
+    settings = {
+        "min_sun_off":     int(cell(2, 10) or 0),    # J2
+        "max_sun_off":     int(cell(3, 10) or 99),   # J3, default high if blank
+        "min_we_off":      int(cell(2, 11) or 0),    # K2
+        "max_we_off":      int(cell(3, 11) or 99),   # K3, default high if blank
+        "min_sun_pm":      int(cell(2, 12) or 0),    # L2, default 0 if blank
+        "max_sun_pm":      int(cell(3, 12) or 99),   # L3
+        "globalmax_pa":    int(cell(2, 14) or 1),    # N2
+        "global_Nspacing": int(cell(2, 9) or 4),     # I2
+        "threshold":       int(cell(2, 15) or 0),    # O2, hour-balance spread
+        "do_penalty":      str(cell(3, 4) or "").strip().upper() == "Y",   # D3
     }
+    settings.update({k: cell(*rc) for k, rc in SOLVER_CELLS.items()})   # F3:H3, F4:G4, as typed
+
+    return RosterInput(
+        month=cell(1, 3), staff=staff, ranks=ranks,
+        quota_arr=np.array(quota_rows, dtype=np.float64).reshape(num_staff, len(QUOTA_KEYS)),
+        start_col=start_col, manpower_row=manpower_row, anchors=anchors,
+        special=special, dates=dates, weekdays=weekdays,
+        cov=cov, rank_mix=rank_mix, req_codes=req_codes, req_grid=req_grid,
+        prev_last7_raw=prev_last7_raw, hr_bounds=hr_bounds,
+        pattern_caps=np.array(caps, dtype=np.int64).reshape(num_staff, 3),
+        daily_pa_cap=daily_pa_cap, settings=settings,
+    )
 
-    # fetch the formula result for init_hr from the values‐only sheet:
-    init_val = ws_values.cell(row=r, column=15).value  # column O (15)
-    quotas[name]["init_hr"] = float(init_val or 0)
-    ws_roster.cell(row=r, column=15, value=init_val)
 
-    r += 1
+# === Structured (non-Excel) input: JSON, or a directory of CSV / Parquet tables ===
+# Same data as the Excel sheet, without cell coordinates. Four tables:
+#
+#   settings : key, value      – month, min_sun_off, max_sun_off, min_we_off, max_we_off,
+#                                min_sun_pm, max_sun_pm, globalmax_pa, global_Nspacing,
+#                                threshold, do_penalty (Y/N), and the solver parameters
+#                                time_limit, workers, seed, relative_gap, preset (SOLVER_CELLS)
+#   staff    : one row/doctor  – name, rank, <QUOTA_KEYS>, hr_min, hr_max, cap_PA, cap_PAN, cap_PPP
+#   days     : one row/day     – date, weekday, tag, AM, PM, Night, pa_cap,
+#                                <group>_minA, _maxA, _minP, _maxP for each group in RANK_MIX_ROWS
+#   requests : one row/request – name, day, code   (day 0 = first day of the month;
+#                                -7 .. -1 = last 7 days of last month)
+#
+# JSON: {"settings": {...}, "staff": [...], "days": [...], "requests": [...]}
+# CSV / Parquet bundle: <dir>/settings.csv, staff.csv, days.csv, requests.csv (or *.parquet).
+# Blank or missing values take the same defaults as blank cells in Roster_input.xlsx.
+INPUT_TABLES  = ("settings", "staff", "days", "requests")
+SETTING_CELLS = {   # setting -> (sheet cell, default when blank/0)
+    "min_sun_off": ("J2", 0),  "max_sun_off": ("J3", 99),
+    "min_we_off":  ("K2", 0),  "max_we_off":  ("K3", 99),
+    "min_sun_pm":  ("L2", 0),  "max_sun_pm":  ("L3", 99),
+    "globalmax_pa": ("N2", 1), "global_Nspacing": ("I2", 4),
+    "threshold":   ("O2", 0),
+}
+CAP_KEYS = ("cap_PA", "cap_PAN", "cap_PPP")
+MIX_KEYS = ("minA", "maxA", "minP", "maxP")
+
+def _blank(v):
+    return v is None or (isinstance(v, str) and not v.strip()) or (isinstance(v, float) and np.isnan(v))
+
+def _int_or(v, dflt):
+    # like int(cell or dflt): blank and 0 both take the default
+    return dflt if _blank(v) or float(v) == 0 else int(float(v))
+
+def _int_strict(v, dflt):
+    # like the sheet's _iv(): blank/non-numeric -> default, 0 stays 0
+    try: return dflt if _blank(v) else int(float(v))
+    except (TypeError, ValueError): return dflt
+
+def roster_input_from_tables(settings, staff_rows, day_rows, request_rows):
+    """Build a RosterInput from the four structured-input tables (lists of dicts)."""
+    staff = [str(r["name"]).strip() for r in staff_rows]
+    ranks = [str(r.get("rank") or "").strip() for r in staff_rows]
+    num_staff, num_days = len(staff), len(day_rows)
+
+    quota_arr = np.array([[np.nan if _blank(r.get(k)) else float(r.get(k)) for k in QUOTA_KEYS]
+                          for r in staff_rows], dtype=np.float64).reshape(num_staff, len(QUOTA_KEYS))
+    hr_bounds = []
+    for r in staff_rows:
+        lb = None if _blank(r.get("hr_min")) else int(float(r["hr_min"]))
+        ub = None if _blank(r.get("hr_max")) else int(float(r["hr_max"]))
+        if (lb is not None) and (ub is not None) and (lb > ub):
+            lb, ub = ub, lb
+        hr_bounds.append((lb, ub))
+    caps = np.array([[_int_strict(r.get(k), 99) for k in CAP_KEYS] for r in staff_rows],
+                    dtype=np.int64).reshape(num_staff, 3)
+
+    dates    = [int(float(r["date"])) for r in day_rows]
+    weekdays = [str(r.get("weekday") or "").upper().strip() for r in day_rows]
+    special  = [str(r.get("tag") or "").upper().strip() for r in day_rows]
+    cov = np.array([[_int_or(r.get(k), 0) for k in ("AM", "PM", "Night")] for r in day_rows],
+                   dtype=np.int64).reshape(num_days, 3)
+    rank_mix = {}
+    for group in RANK_MIX_ROWS:
+        rd = _int_or if group == "senior" else _int_strict
+        rank_mix[group] = np.array([[rd(r.get(f"{group}_{k}"), dflt) for r in day_rows]
+                                    for k, dflt in zip(MIX_KEYS, (0, 99, 0, 99))],
+                                   dtype=np.int64).reshape(4, num_days)
+    daily_pa_cap = np.array([_int_strict(r.get("pa_cap"), num_staff) for r in day_rows], dtype=np.int64)
+
+    s_idx = {name: s for s, name in enumerate(staff)}
+    req_codes, code_idx = [], {}
+    req_grid = np.full((num_staff, num_days), -1, dtype=np.int16)
+    prev_last7_raw = [[None] * 7 for _ in range(num_staff)]
+    for r in request_rows:
+        name, code = str(r["name"]).strip(), r.get("code")
+        if name not in s_idx:
+            raise ValueError(f"❌ Request for unknown staff '{name}'.")
+        if _blank(code):
+            continue
+        s, d, code = s_idx[name], int(float(r["day"])), str(code).strip()
+        if -7 <= d < 0:
+            prev_last7_raw[s][7 + d] = code
+        elif 0 <= d < num_days:
+            if code not in code_idx:
+                code_idx[code] = len(req_codes)
+                req_codes.append(code)
+            req_grid[s, d] = code_idx[code]
+        else:
+            raise ValueError(f"❌ Request day {d} for '{name}' is outside the roster.")
+
+    settings_out = {k: _int_or(settings.get(k), dflt) for k, (_, dflt) in SETTING_CELLS.items()}
+    settings_out["do_penalty"] = str(settings.get("do_penalty") or "").strip().upper() in ("Y", "TRUE", "1")
+    settings_out.update({k: None if _blank(settings.get(k)) else settings[k] for k in SOLVER_CELLS})
+
+    return RosterInput(
+        month=settings.get("month"), staff=staff, ranks=ranks, quota_arr=quota_arr,
+        start_col=None, manpower_row=None, anchors={},
+        special=special, dates=dates, weekdays=weekdays,
+        cov=cov, rank_mix=rank_mix, req_codes=req_codes, req_grid=req_grid,
+        prev_last7_raw=prev_last7_raw, hr_bounds=hr_bounds, pattern_caps=caps,
+        daily_pa_cap=daily_pa_cap, settings=settings_out,
+    )
 
-NUM_STAFF = len(staff)
+def roster_input_to_tables(roster):
+    """Inverse of roster_input_from_tables(): the four tables as plain Python values."""
+    settings = {"month": None if roster.month is None else str(roster.month)}
+    settings.update({k: roster.settings[k] for k in SETTING_CELLS})
+    settings.update({k: roster.settings.get(k) for k in SOLVER_CELLS})
+    settings["do_penalty"] = "Y" if roster.settings["do_penalty"] else "N"
+
+    staff_rows = []
+    for s, name in enumerate(roster.staff):
+        row = {"name": name, "rank": roster.ranks[s]}
+        row.update({k: (None if np.isnan(v) else float(v)) for k, v in zip(QUOTA_KEYS, roster.quota_arr[s])})
+        row["hr_min"], row["hr_max"] = roster.hr_bounds[s]
+        row.update(zip(CAP_KEYS, roster.pattern_caps[s].tolist()))
+        staff_rows.append(row)
+
+    day_rows = []
+    for d in range(len(roster.dates)):
+        row = {"date": roster.dates[d], "weekday": roster.weekdays[d], "tag": roster.special[d]}
+        row.update(zip(("AM", "PM", "Night"), roster.cov[d].tolist()))
+        row["pa_cap"] = int(roster.daily_pa_cap[d])
+        for group, arr in roster.rank_mix.items():
+            row.update({f"{group}_{k}": int(v) for k, v in zip(MIX_KEYS, arr[:, d])})
+        day_rows.append(row)
+
+    request_rows = [{"name": roster.staff[s], "day": i - 7, "code": str(v).strip()}
+                    for s, row in enumerate(roster.prev_last7_raw) for i, v in enumerate(row)
+                    if isinstance(v, str) and v.strip()]
+    request_rows += [{"name": roster.staff[s], "day": d, "code": code}
+                     for (s, d), code in sorted(roster.fixed_raw.items())]
+    return settings, staff_rows, day_rows, request_rows
+
+def load_structured_input(path):
+    """Load a .json file or a CSV / Parquet table bundle (directory) into a RosterInput."""
+    if os.path.isdir(path):
+        import pandas as pd
+        def _table(name):
+            csv, pq = os.path.join(path, name + ".csv"), os.path.join(path, name + ".parquet")
+            if os.path.exists(pq):
+                df = pd.read_parquet(pq)   # needs pyarrow or fastparquet
+            elif os.path.exists(csv):
+                df = pd.read_csv(csv, dtype=str, keep_default_na=False)
+            else:
+                raise FileNotFoundError(f"❌ Missing {name}.csv / {name}.parquet in {path}")
+            return [{k: (None if _blank(v) else v) for k, v in rec.items()}
+                    for rec in df.to_dict(orient="records")]
+        settings = {r["key"]: r["value"] for r in _table("settings")}
+        return roster_input_from_tables(settings, _table("staff"), _table("days"), _table("requests"))
+
+    with open(path, encoding="utf-8") as f:
+        doc = json.load(f)
+    return roster_input_from_tables(*(doc.get(k) or ({} if k == "settings" else []) for k in INPUT_TABLES))
+
+def export_structured_input(roster, path):
+    """Write a RosterInput as JSON (path ending in .json) or as a CSV bundle (directory)."""
+    tables = dict(zip(INPUT_TABLES, roster_input_to_tables(roster)))
+    if path.lower().endswith(".json"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(tables, f, ensure_ascii=False, indent=1)
+        return
+    import pandas as pd
+    os.makedirs(path, exist_ok=True)
+    tables["settings"] = [{"key": k, "value": v} for k, v in tables["settings"].items()]
+    for name in INPUT_TABLES:
+        pd.DataFrame(tables[name]).to_csv(os.path.join(path, name + ".csv"), index=False)
+
+
+# === Parsed-input cache ===
+# Key = parser version + sheet name + hash of the workbook parts the loader reads
+# (workbook, worksheets, shared strings, styles). Comments, theme, calcChain and
+# docProps are left out, so re-saving or annotating the file still hits the cache.
+_CACHE_PARTS = ("xl/workbook.xml", "xl/worksheets/", "xl/sharedStrings.xml", "xl/styles.xml")
+
+def _roster_cache_key(path, sheet_name):
+    h = hashlib.sha256(f"v{PARSER_VERSION}|{sheet_name}|".encode())
+    try:
+        with zipfile.ZipFile(path) as z:
+            for n in sorted(z.namelist()):
+                if n.startswith(_CACHE_PARTS):
+                    h.update(n.encode())
+                    h.update(z.read(n))
+    except zipfile.BadZipFile:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def load_roster_input_cached(path, sheet_name=SHEET_NAME, cache_dir=ROSTER_CACHE_DIR):
+    """load_roster_input() with an on-disk pickle cache keyed by content hash."""
+    if not cache_dir:
+        return load_roster_input(path, sheet_name)
+    cache_file = os.path.join(cache_dir, _roster_cache_key(path, sheet_name) + ".pkl")
+    try:
+        with open(cache_file, "rb") as f:
+            roster = pickle.load(f)
+        os.utime(cache_file)   # mark as recently used
+        print(f"➡️  Using cached input ({cache_file})")
+        return roster
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    roster = load_roster_input(path, sheet_name)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_file + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(roster, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+        # prune least recently used entries
+        entries = sorted((os.path.join(cache_dir, n) for n in os.listdir(cache_dir) if n.endswith(".pkl")),
+                         key=os.path.getmtime, reverse=True)
+        for old in entries[ROSTER_CACHE_KEEP:]:
+            os.remove(old)
+    except OSError as e:
+        print(f"⚠️ Could not write input cache: {e}")
+    return roster
+
+
+# === Rule spec (--rules) ===
+# The rule families below are declarative entries, compiled into the model by the shared
+# builders in 2.1e. DEFAULT_RULES is the department's rule set; a --rules file replaces it,
+# or, with "extends": "default", edits it: an entry named like a default rule replaces that
+# rule, "enabled": false drops it, any other entry is added.
+#
+#   type          fields                     rule
+#   coverage      -                          daily A / P / N headcount from the Manpower block
+#   rank_mix      groups                     per-day A / P min / max rows below Manpower (RANK_MIX_ROWS)
+#   night_quotas  -                          N* / N / N3 quotas (cols E–G), one N* and one N per day
+#   window        shifts, length, max        ≤ max such days in any `length`-day window (last month counts)
+#   weekly_cap    shifts, max [week_start]   ≤ max such days per 7-day block from the first week_start day
+#                                            (default: from day 1)
+#   sequence      first, then [on]           no `first` on a day followed by `then` the next day;
+#                                            on = [weekday, next weekday] limits it to those pairs
+#   daily_count   shifts [min] [max]         per day, how many of the staff work such a shift
+#   quota         shifts [min] [max]         per staff, how many such days in the month
+#
+# shifts / first / then: class names (AM, PM, NIGHT, OFF, WORK) and / or shift codes (SHIFTS).
+# Optional on every rule: ranks (rank prefixes, default everyone); on daily_count / quota:
+# day_type ("WE" / "WD") and weekdays (["SAT", "SUN"], ...). in_automaton: the sequence
+# automaton already encodes the rule, so --sequence-mode automaton skips it.
+# On window and quota rules, length / min / max may name a sheet value (SHEET_VALUE_NAMES)
+# instead of a number, or list several: the first one given for the staff row is used, and a
+# bound with none given is left out (so a blank SUN-Off quota adds no constraint).
+# "penalties" are the D3 = Y weights of the patterns; "X" forbids the pattern instead.
+#
+# Not in the spec: the specialist-on-A rule (an A not followed by a Night, per day, over the
+# CON1-3 / AC rows), the hour balance (hours per shift, the O2 envelope and the P / Q personal
+# ranges) and the P/A ratios (cols M–N and N2); none of them is a count of days in a shift
+# selection. They stay in Python below, reading their limits from the sheet as before.
+SHEET_VALUE_NAMES = (
+    "Nspacing", "SUN-Off", "WE-Off", "SUN P",          # per staff, cols I–L (Nspacing: at least I2)
+    "min_sun_off", "max_sun_off", "min_we_off", "max_we_off", "min_sun_pm", "max_sun_pm",   # J2–L3
+)
+DEFAULT_RULES = {
+    "rules": [
+        {"name": "rank mix",        "type": "rank_mix", "groups": ["junior", "conac", "ac", "ht", "bt", "e"]},
+        {"name": "coverage",        "type": "coverage"},
+        {"name": "sat-sun PM",      "type": "sequence", "first": "PM", "then": "PM", "on": ["SAT", "SUN"],
+         "in_automaton": True},
+        {"name": "night quotas",    "type": "night_quotas"},
+        {"name": "CON weekly Z",    "type": "weekly_cap", "shifts": "Z", "max": 5, "ranks": ["CON1", "CON2"]},
+        {"name": "senior mix",      "type": "rank_mix", "groups": ["senior"]},
+        {"name": "6 in 7",          "type": "window", "shifts": "WORK", "length": 7, "max": 6},
+        {"name": "HT on weekend A", "type": "daily_count", "shifts": "A", "min": 1, "ranks": ["HT1", "HT2"],
+         "day_type": "WE"},
+        {"name": "weekly PM cap",   "type": "weekly_cap", "shifts": "PM", "max": 4, "week_start": "SUN"},
+        {"name": "off after night", "type": "sequence", "first": "NIGHT", "then": "WORK", "in_automaton": True},
+        {"name": "night after A",   "type": "sequence", "first": ["OFF", "PM", "NIGHT", "Z", "T", "½t", "½Z"],
+         "then": "NIGHT", "in_automaton": True},
+        {"name": "night spacing",   "type": "window", "shifts": "NIGHT", "length": "Nspacing", "max": 1},
+        {"name": "SUN-Off quota",   "type": "quota", "shifts": "OFF", "weekdays": ["SUN"],
+         "min": "SUN-Off", "max": "SUN-Off"},
+        {"name": "WE-Off quota",    "type": "quota", "shifts": "OFF", "day_type": "WE",
+         "min": "WE-Off", "max": "WE-Off"},
+        {"name": "Sunday Off",      "type": "quota", "shifts": "OFF", "weekdays": ["SUN"],
+         "min": "min_sun_off", "max": "max_sun_off"},
+        {"name": "weekend Off",     "type": "quota", "shifts": "OFF", "day_type": "WE",
+         "min": "min_we_off", "max": "max_we_off"},
+        {"name": "Sunday P",        "type": "quota", "shifts": "P", "weekdays": ["SUN"],
+         "min": ["SUN P", "min_sun_pm"], "max": "max_sun_pm"},
+        {"name": "SUN P quota",     "type": "quota", "shifts": "P", "weekdays": ["SUN"], "min": "SUN P", "max": "SUN P"},
+    ],
+    "penalties": {
+        "PAN":  10000,   # PM→AM→Night chains
+        "PA":   1000,    # PM→AM transitions
+        "PPP":  1000,    # 3 consecutive PMs
+        "PPPP": "X",     # 4 consecutive PMs (here: prohibit)
+    },
+}
 
-# === Global constraints - Min SUN Off, Min WE Off, Max SUN P, Max P/A ratio
-min_sun_off = int(ws_roster["J2"].value or 0)
-min_we_off  = int(ws_roster["K2"].value or 0)
-max_sun_pm = int(ws_roster["L3"].value or 99)
+# type -> (required fields, optional fields)
+RULE_FIELDS = {
+    "coverage":     ((), ()),
+    "rank_mix":     (("groups",), ()),
+    "night_quotas": ((), ()),
+    "window":       (("shifts", "length", "max"), ("ranks",)),
+    "weekly_cap":   (("shifts", "max"), ("ranks", "week_start")),
+    "sequence":     (("first", "then"), ("ranks", "on", "in_automaton")),
+    "daily_count":  (("shifts",), ("ranks", "day_type", "weekdays", "min", "max")),
+    "quota":        (("shifts",), ("ranks", "day_type", "weekdays", "min", "max")),
+}
 
-max_sun_off = int(ws_roster["J3"].value or 99)   # default high if blank
-max_we_off  = int(ws_roster["K3"].value or 99)   # default high if blank
-min_sun_pm  = int(ws_roster["L2"].value or 0)    # default 0 if blank
+def check_rule_spec(spec):
+    """Raise ValueError for anything the compiler cannot read (shift names are checked when compiling)."""
+    names = set()
+    for rule in spec.get("rules", []):
+        name, kind = rule.get("name"), rule.get("type")
+        if not name or name in names:
+            raise ValueError(f"❌ Rule spec: every rule needs a unique name ({rule})")
+        names.add(name)
+        if kind not in RULE_FIELDS:
+            raise ValueError(f"❌ Rule spec: {name}: unknown type {kind!r}")
+        required, optional = RULE_FIELDS[kind]
+        missing = [k for k in required if k not in rule]
+        unknown = set(rule) - set(required) - set(optional) - {"name", "type", "enabled"}
+        if missing or unknown:
+            raise ValueError(f"❌ Rule spec: {name}: missing {missing or '-'}, unknown {sorted(unknown) or '-'}")
+        if kind in ("daily_count", "quota") and "min" not in rule and "max" not in rule:
+            raise ValueError(f"❌ Rule spec: {name}: needs min and / or max")
+        for k in ("length", "max", "min"):
+            if k not in rule:
+                continue
+            vals = rule[k] if isinstance(rule[k], list) and kind in ("window", "quota") else [rule[k]]
+            for v in vals:
+                if isinstance(v, str) and kind in ("window", "quota"):
+                    if v not in SHEET_VALUE_NAMES:
+                        raise ValueError(f"❌ Rule spec: {name}: {k}: unknown sheet value {v!r} "
+                                         f"(use {', '.join(SHEET_VALUE_NAMES)})")
+                elif not isinstance(v, int) or v < (1 if k == "length" else 0):
+                    raise ValueError(f"❌ Rule spec: {name}: {k} must be a whole number"
+                                     + (" or a sheet value" if kind in ("window", "quota") else ""))
+        bad = [g for g in rule.get("groups", []) if g not in RANK_MIX_ROWS]
+        if bad:
+            raise ValueError(f"❌ Rule spec: {name}: unknown rank-mix group(s) {bad}")
+    for pattern, w in spec.get("penalties", {}).items():
+        if pattern not in DEFAULT_RULES["penalties"] or not (w == "X" or isinstance(w, int) and w >= 0):
+            raise ValueError(f"❌ Rule spec: penalty {pattern}: {w!r} (patterns PAN / PA / PPP / PPPP, "
+                             f"weight a whole number or \"X\")")
+    return spec
+
+def load_rule_spec(path):
+    """The rule spec from a .json / .yaml file (None: DEFAULT_RULES), checked and with defaults applied."""
+    if not path:
+        return check_rule_spec(json.loads(json.dumps(DEFAULT_RULES)))
+    with open(path, encoding="utf-8") as f:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("❌ YAML rule specs need PyYAML (pip install pyyaml), or use .json")
+            spec = yaml.safe_load(f) or {}
+        else:
+            spec = json.load(f)
+    if spec.get("extends") == "default":
+        own = {r.get("name"): r for r in spec.get("rules", [])}
+        rules = [own.pop(r["name"], r) for r in DEFAULT_RULES["rules"]] + list(own.values())
+        spec = {"rules": rules, "penalties": {**DEFAULT_RULES["penalties"], **spec.get("penalties", {})}}
+    spec = {"rules": [r for r in spec.get("rules", []) if r.get("enabled", True)],
+            "penalties": {**DEFAULT_RULES["penalties"], **spec.get("penalties", {})}}
+    return check_rule_spec(spec)
+
+if args.export_rules:
+    with open(args.export_rules, "w", encoding="utf-8") as f:
+        json.dump(DEFAULT_RULES, f, ensure_ascii=False, indent=1)
+    print(f"✅ Written {args.export_rules}")
+    sys.exit(0)
+
+RULES = load_rule_spec(args.rules)
+if args.rules:
+    print(f"➡️  Rule spec {args.rules}: {len(RULES['rules'])} rule(s)")
+
+def rules_of(kind):
+    return [r for r in RULES["rules"] if r["type"] == kind]
+
+
+if INPUT_IS_EXCEL:
+    roster = load_roster_input_cached(INPUT_ROSTER, SHEET_NAME)
+else:
+    roster = load_structured_input(INPUT_ROSTER)
 
+if args.export_input:
+    export_structured_input(roster, args.export_input)
+    print(f"✅ Written {args.export_input}")
+    sys.exit(0)
 
-globalmax_pa = int(ws_roster["N2"].value or 1)
-global_Nspacing = int(ws_roster["I2"].value or 4)
+print("➡️  Solving...")
 
+# Month
+month = roster.month
 
-# 1.3 Locate Day Block
-col = 1
-while True:
-    if str(ws_roster.cell(row=1, column=col).value or "").strip().upper() == "START":
-        START_COL = col + 1
-        break
-    col += 1
-
-# 1.4 Read days
-special, dates, weekdays = [], [], []
-col = START_COL
-while True:
-    tag = ws_roster.cell(row=1, column=col).value
-    date = ws_roster.cell(row=3, column=col).value
-    wd   = ws_roster.cell(row=4, column=col).value
-    if date is None:
-        break
-    special.append(str(tag or "").upper().strip())
-    dates.append(date.day if isinstance(date, datetime.datetime) else int(date))
-    weekdays.append(str(wd or "").upper().strip())
-    col += 1
+# === 1.2 Staff & quotas ===
+staff, ranks, quotas = roster.staff, roster.ranks, roster.quotas
+NUM_STAFF = len(staff)
+
+# === Global constraints - Min SUN Off, Min WE Off, Max SUN P, Max P/A ratio
+min_sun_off = roster.settings["min_sun_off"]
+min_we_off  = roster.settings["min_we_off"]
+max_sun_pm  = roster.settings["max_sun_pm"]
+
+max_sun_off = roster.settings["max_sun_off"]
+max_we_off  = roster.settings["max_we_off"]
+min_sun_pm  = roster.settings["min_sun_pm"]
+
+globalmax_pa    = roster.settings["globalmax_pa"]
+global_Nspacing = roster.settings["global_Nspacing"]
+
+# per-staff sheet values (SHEET_VALUE_NAMES) -> their value for staff row s, None = blank;
+# the others are the global settings of the same name
+SHEET_VALUES = {
+    "Nspacing": lambda s: max(int(quotas[staff[s]].get("Nspacing", 0)), global_Nspacing),
+    "SUN-Off":  lambda s: quotas[staff[s]]["SUN-Off"],
+    "WE-Off":   lambda s: quotas[staff[s]]["WE-Off"],
+    "SUN P":    lambda s: quotas[staff[s]]["SUN P"],
+}
 
+# 1.3/1.4 Day block
+START_COL = roster.start_col
+special, dates, weekdays = roster.special, roster.dates, roster.weekdays
 NUM_DAYS = len(dates)
-LAST_COL = START_COL + NUM_DAYS - 1
+LAST_COL = START_COL + NUM_DAYS - 1 if START_COL else None
 
+# 1.5 'Manpower' block
+manpower_row = roster.manpower_row
 
-# === 1.5 Read per-day coverage targets from 'Manpower' block ===
-# Find the row and column of the cell containing 'Manpower'
-manpower_row, manpower_col = None, None
-for row in range(1, 100):  # Search within first 100 rows
-    for col in range(1, ws_roster.max_column + 1):
-        val = str(ws_roster.cell(row=row, column=col).value or "").strip()
-        if val.upper() == "MANPOWER":
-            manpower_row, manpower_col = row, col
-            break
-    if manpower_row:
-        break
-if manpower_row is None:
-    raise ValueError("❌ Could not locate 'Manpower' cell in Roster sheet.")
-
-    
-# 1.6 Classify days
-day_type = []
-for i in range(NUM_DAYS):
-    tag, wd = special[i], weekdays[i]
-    if wd in ("SAT", "SUN") or tag.startswith(("SH", "PH")):
-        day_type.append("WE")   # Weekend / Holiday
-    else:
-        day_type.append("WD")   # Regular weekday
+# 1.6 Classify days (WE = Weekend / Holiday, WD = Regular weekday)
+day_type = roster.day_type
 
 # 1.7 Duty requests
-fixed_raw, fixed_clean = {}, {}
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        cell = ws_roster.cell(row=ROW_START+s, column=START_COL+d)
-        v = cell.value
-        if isinstance(v, str) and v.strip():
-            orig = v.strip()
-            fixed_raw[(s,d)] = orig
-            fixed_clean[(s,d)] = orig.rstrip("↗").strip()
-            # fixed_clean[(s,d)] = orig.rstrip("↗").strip().upper()
+fixed_raw, fixed_clean = roster.fixed_raw, roster.fixed_clean
 
 
 
@@ -151,37 +804,55 @@ PM_SH    = {"P"}
 NIGHT_SH = {"N*","N","N3"}
 OFF      = {"O","AL","☆","½●½O","兒","父","SH","PH"}
 
-model = cp_model.CpModel()
-X = {}
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        for t in SHIFTS:
-            X[s,d,t] = model.NewBoolVar(f"x_{s}_{d}_{t}")
-
-
-
-# Read coverage targets for each day by column
-cov_targets_per_day = []  # List of tuples: (AM, PM, Night)
-for offset in range(NUM_DAYS):
-    col = START_COL + offset
-    am = int(ws_roster.cell(row=manpower_row + 1, column=col).value or 0)
-    pm = int(ws_roster.cell(row=manpower_row + 2, column=col).value or 0)
-    nt = int(ws_roster.cell(row=manpower_row + 3, column=col).value or 0)
-    cov_targets_per_day.append((am, pm, nt))
-
-# === Read senior constraints (min/max for A and P) ===
-minsenA_per_day, maxsenA_per_day = [], []
-minsenP_per_day, maxsenP_per_day = [], []
-
-for offset in range(NUM_DAYS):
-    col = START_COL + offset
-    # seniors (you already had these)
-    minsenA = int(ws_roster.cell(row=manpower_row + 4, column=col).value or 0)
-    maxsenA = int(ws_roster.cell(row=manpower_row + 5, column=col).value or 99)
-    minsenP = int(ws_roster.cell(row=manpower_row + 6, column=col).value or 0)
-    maxsenP = int(ws_roster.cell(row=manpower_row + 7, column=col).value or 99)
-    minsenA_per_day.append(minsenA); maxsenA_per_day.append(maxsenA)
-    minsenP_per_day.append(minsenP); maxsenP_per_day.append(maxsenP)
+# Forbid Z, T, ½t, etc unless explicitly pre-filled in the sheet
+SPECIAL_FIXED_ONLY = {"Z", "T", "½t","½Z","AL","☆","½●½O","兒","父","SH","PH"}
+
+# 2.3 Shift-code table: each code is the small int k = its position in SHIFTS (the t axis of
+# every [s, d, t] array) and SHIFT_CLASS[k] is its class bitmask, so class membership is an
+# integer AND instead of a string-set lookup. Each code also carries its own bit (CLS_CODE << k),
+# so a rule's shift selection ("PM", ["Z"], ["NIGHT", "Z"], ...) is one bitmask as well.
+CLS_AM, CLS_PM, CLS_NIGHT, CLS_OFF, CLS_WORK, CLS_FIXED, CLS_CODE = 1, 2, 4, 8, 16, 32, 64
+CLASS_NAMES = {"AM": CLS_AM, "PM": CLS_PM, "NIGHT": CLS_NIGHT, "OFF": CLS_OFF, "WORK": CLS_WORK}
+SHIFT_CODE  = {t: k for k, t in enumerate(SHIFTS)}
+SHIFT_CLASS = np.array([CLS_AM * (t in AM_SH) | CLS_PM * (t in PM_SH) | CLS_NIGHT * (t in NIGHT_SH)
+                        | (CLS_OFF if t in OFF else CLS_WORK) | CLS_FIXED * (t in SPECIAL_FIXED_ONLY)
+                        | CLS_CODE << k
+                        for k, t in enumerate(SHIFTS)], dtype=np.int64)
+CODE_CLASS  = dict(zip(SHIFTS, SHIFT_CLASS.tolist()))
+SH_A, SH_P, SH_O, SH_Z = (SHIFT_CODE[t] for t in ("A", "P", "O", "Z"))
+
+def codes_of(cls):
+    """Shift codes (ints) in any of the classes in the bitmask cls."""
+    return np.flatnonzero(SHIFT_CLASS & cls)
+
+def code_class(code) -> int:
+    """Class bitmask of a code string; 0 for blanks and codes outside SHIFTS."""
+    return CODE_CLASS.get(code, 0)
+
+def shift_bits(names):
+    """Bitmask of a rule's shift selection: class names and / or shift codes."""
+    bits = 0
+    for n in [names] if isinstance(names, str) else names:
+        if n in CLASS_NAMES:
+            bits |= CLASS_NAMES[n]
+        elif n in SHIFT_CODE:
+            bits |= CLS_CODE << SHIFT_CODE[n]
+        else:
+            raise ValueError(f"❌ Rule spec: unknown shift or class {n!r}")
+    return bits
+
+def prev_flags(s, bits):
+    """Last month's days -7 .. -1 of staff s that count for bits; for WORK any code that is not OFF counts."""
+    flags = []
+    for code in prev_last7[s]:
+        c = code_class(str(code or "").strip())
+        flags.append(int(bool(c & bits) or bool(bits & CLS_WORK) and not c & CLS_OFF))
+    return flags
+
+
+# Coverage targets for each day
+cov_targets_per_day = [tuple(row) for row in roster.cov.tolist()]  # List of tuples: (AM, PM, Night)
+COV = np.array(cov_targets_per_day, dtype=np.int64).reshape(-1, 3)  # same, as a (days, 3) array
 
 # === Cadre index sets ===
 # Seniors: CON*, AC, HT1
@@ -197,108 +868,49 @@ ht_idx    = {s for s, r in enumerate(ranks) if str(r).upper().startswith(("HT1",
 bt_idx    = {s for s, r in enumerate(ranks) if str(r).upper().startswith("BT")}
 e_idx     = {s for s, r in enumerate(ranks) if str(r).upper().startswith("E")}
 
-# === Helpers to read & enforce per-day min/max A/P for any group ===
-def _read_minmax_rows(r_minA, r_maxA, r_minP, r_maxP):
-    minA, maxA, minP, maxP = [], [], [], []
-    for off in range(NUM_DAYS):
-        c = START_COL + off
-        def _iv(v, dflt): 
-            try: return int(v) if v not in (None, "") else dflt
-            except: return dflt
-        minA.append(_iv(ws_roster.cell(row=r_minA, column=c).value, 0))
-        maxA.append(_iv(ws_roster.cell(row=r_maxA, column=c).value, 99))
-        minP.append(_iv(ws_roster.cell(row=r_minP, column=c).value, 0))
-        maxP.append(_iv(ws_roster.cell(row=r_maxP, column=c).value, 99))
-    return minA, maxA, minP, maxP
-
+# rank-mix group (RANK_MIX_ROWS key) -> its staff
+RANK_GROUPS = {"senior": senior_idx, "junior": junior_idx, "conac": conac_idx, "ac": ac_idx,
+               "ht": ht_idx, "bt": bt_idx, "e": e_idx}
+
+def rule_staff(rule):
+    """Staff a rule applies to: rank prefixes in rule["ranks"], default everyone."""
+    prefixes = tuple(p.upper() for p in rule.get("ranks", ()))
+    return [s for s, r in enumerate(ranks) if not prefixes or str(r).upper().startswith(prefixes)]
+
+def rule_days(rule):
+    """Days a rule applies to: rule["day_type"] (WE / WD) and rule["weekdays"], default every day."""
+    wds = {w.upper() for w in rule.get("weekdays", ())}
+    return [d for d in range(NUM_DAYS)
+            if rule.get("day_type", day_type[d]) == day_type[d] and (not wds or weekdays[d] in wds)]
+
+def rule_value(rule, key, s):
+    """rule[key] for staff row s: a number, or the first sheet value given for the row; None if none is."""
+    v = rule.get(key)
+    for x in v if isinstance(v, list) else [v]:
+        if isinstance(x, str):
+            x = SHEET_VALUES[x](s) if x in SHEET_VALUES else roster.settings[x]
+        if x is not None:
+            return int(x)
+    return None
+
+# === Helper to enforce per-day min/max A/P for any group ===
 def _enforce_group_minmax(group_idx, minA, maxA, minP, maxP):
-    for d in range(NUM_DAYS):
-        am_cov, pm_cov, _ = cov_targets_per_day[d]
-        # clamp to coverage
-        a_min = min(minA[d], am_cov); a_max = min(maxA[d], am_cov)
-        p_min = min(minP[d], pm_cov); p_max = min(maxP[d], pm_cov)
-        model.Add(sum(X[s, d, "A"] for s in group_idx) >= a_min)
-        model.Add(sum(X[s, d, "A"] for s in group_idx) <= a_max)
-        model.Add(sum(X[s, d, "P"] for s in group_idx) >= p_min)
-        model.Add(sum(X[s, d, "P"] for s in group_idx) <= p_max)
-
-# === Read per-day min/max rows for each extra group ===
-# Adjust these offsets to match your sheet:
-junA_min, junA_max, junP_min, junP_max = _read_minmax_rows(manpower_row+8,  manpower_row+9,  manpower_row+10, manpower_row+11)  # Juniors
-caA_min,  caA_max,  caP_min,  caP_max  = _read_minmax_rows(manpower_row+12, manpower_row+13, manpower_row+14, manpower_row+15)  # CON+AC
-acA_min,  acA_max,  acP_min,  acP_max  = _read_minmax_rows(manpower_row+16, manpower_row+17, manpower_row+18, manpower_row+19)  # AC only
-htA_min,  htA_max,  htP_min,  htP_max  = _read_minmax_rows(manpower_row+20, manpower_row+21, manpower_row+22, manpower_row+23)  # HT (HT1+HT2)
-btA_min,  btA_max,  btP_min,  btP_max  = _read_minmax_rows(manpower_row+24, manpower_row+25, manpower_row+26, manpower_row+27)  # BT
-eA_min,   eA_max,   eP_min,   eP_max   = _read_minmax_rows(manpower_row+28, manpower_row+29, manpower_row+30, manpower_row+31)  # E
-
-# === Enforce (keep your existing senior enforcement wherever it lives) ===
-_enforce_group_minmax(junior_idx, junA_min, junA_max, junP_min, junP_max)
-_enforce_group_minmax(conac_idx,   caA_min,  caA_max,  caP_min,  caP_max)
-_enforce_group_minmax(ac_idx,      acA_min,  acA_max,  acP_min,  acP_max)
-_enforce_group_minmax(ht_idx,      htA_min,  htA_max,  htP_min,  htP_max)
-_enforce_group_minmax(bt_idx,      btA_min,  btA_max,  btP_min,  btP_max)
-_enforce_group_minmax(e_idx,       eA_min,   eA_max,   eP_min,   eP_max)
-
-
-# one shift/day
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        model.AddExactlyOne(X[s,d,t] for t in SHIFTS)
-
-# Forbid Z, T, ½t, etc unless explicitly pre-filled in the sheet
-SPECIAL_FIXED_ONLY = {"Z", "T", "½t","½Z","AL","☆","½●½O","兒","父","SH","PH"}
-
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        for sp in SPECIAL_FIXED_ONLY:
-            # only allow if user pre-filled exactly this code
-            if not ((s, d) in fixed_clean and fixed_clean[(s, d)] == sp):
-                model.Add(X[s, d, sp] == 0)
-
-
-# === Read last 7 days of LAST month (reference only) — shifted one col left ===
-from openpyxl.utils import get_column_letter
-
-def split_arrow(val):
-    """Return (core, has_arrow). core has any trailing ↗ removed."""
-    s = str(val or "").strip()
-    if s.endswith("↗"):
-        return s[:-1].strip(), True
-    return s, False
-
-# safety: now we need 8 columns before START (to reach START_COL - 8)
-if START_COL <= 8:
-    raise RuntimeError("Not enough columns before START to read last 7 days (shifted left).")
-
-# Columns for last week (left→right): START_COL-8 ... START_COL-2
-last7_cols = list(range(START_COL - 8, START_COL - 1))
-last7_letters = [get_column_letter(c) for c in last7_cols]
-
-# Per-staff arrays
-# prev_last7[s][i]  -> clean duty code at row s, col last7_cols[i]
-# prev_last7_raw[s] -> raw cell value (keeps ↗ if present)
+    # one [min, max] row per day and shift, clamped to coverage
+    am_cov, pm_cov = COV[:, 0], COV[:, 1]
+    bulk.add_linear(*x_rows([SH_A], "day", group_idx), 1, np.minimum(minA, am_cov), np.minimum(maxA, am_cov))
+    bulk.add_linear(*x_rows([SH_P], "day", group_idx), 1, np.minimum(minP, pm_cov), np.minimum(maxP, pm_cov))
+
+# === Last 7 days of LAST month (reference only) — cols START_COL-8 ... START_COL-2 ===
+# prev_last7[s][i]       -> clean duty code (empty -> Off)
+# prev_last7_raw[s][i]   -> raw cell value (keeps ↗ if present)
 # prev_last7_arrow[s][i] -> True if that cell had ↗
-prev_last7       = [[None]*7 for _ in range(NUM_STAFF)]
-prev_last7_raw   = [[None]*7 for _ in range(NUM_STAFF)]
-prev_last7_arrow = [[False]*7 for _ in range(NUM_STAFF)]
+prev_last7       = roster.prev_last7
+prev_last7_raw   = roster.prev_last7_raw
+prev_last7_arrow = roster.prev_last7_arrow
 
-for s in range(NUM_STAFF):
-    row = ROW_START + s
-    for i, c in enumerate(last7_cols):
-        raw = ws_roster.cell(row=row, column=c).value
-        core, has_arr = split_arrow(raw)
-        if core == "":
-            core = "O"  # empty -> Off
-        prev_last7[s][i]       = core
-        prev_last7_raw[s][i]   = raw
-        prev_last7_arrow[s][i] = has_arr
-
-# === Enforce duty‐request overrides ===
-for (s, d), clean in fixed_clean.items():
-    orig = fixed_raw[(s, d)]
-    arrow = orig.endswith("↗")  # (unused here, ok to keep/remove)
-        
-    # map request to allowed shifts
+
+def allowed_for_request(clean):
+    """Map a pre-filled request code to the set of shifts it allows."""
     if clean == "A":
         allowed = AM_SH                  # {"A"}
     elif clean == "P":
@@ -348,255 +960,852 @@ for (s, d), clean in fixed_clean.items():
         allowed = NIGHT_SH               # {"N*","N","N3"}
     else:
         allowed = OFF                    # fallback: any OFF-type
+    return allowed
+
+
+# === 2.0 Pre-check (sequence rules + counting bounds; runs before the model is built) ===
+# Each staff row is scanned against the Night / spacing / window rules, and each day /
+# group / staff is checked against what the fixed cells, rank rules and quotas leave possible. Anything reported here makes the CP-SAT model infeasible, so we stop
+# instead of waiting for the solver's time limit.  Skip with --no-precheck.
+COVER_CLASSES = (("AM", AM_SH), ("PM", PM_SH), ("Night", NIGHT_SH))
+
+def day_label(d):
+    # d < 0: the last 7 days of last month (-1 = its last day)
+    return f"{dates[d]} {weekdays[d]}" if d >= 0 else f"last month day {d}"
+
+def cell_domains():
+    """dom[s][d] = shifts still possible for (s, d) from cell-local rules alone:
+    requests, fixed-only codes, COS / CON1-2 rows, zero night quotas, no Night after a
+    fixed A↗, and day 0 against the last day of last month."""
+    free = set(SHIFTS) - SPECIAL_FIXED_ONLY
+    dom = []
+    for s, name in enumerate(staff):
+        rank = ranks[s].upper()
+        no_night = {t for t in NIGHT_SH if quotas[name][t] == 0}
+        row = []
+        for d in range(NUM_DAYS):
+            if (s, d) in fixed_clean:
+                clean = fixed_clean[(s, d)]
+                cell = set(allowed_for_request(clean)) - (SPECIAL_FIXED_ONLY - {clean})
+            elif rank.startswith("COS"):
+                cell = free & OFF
+            elif rank.startswith(("CON1", "CON2")):
+                cell = free & (OFF if day_type[d] == "WE" else {"A", "Z"} | OFF)
+            else:
+                cell = set(free)
+            row.append(cell - no_night)
+        # a fixed A↗ goes off duty: no Night the next day
+        for d in range(NUM_DAYS - 1):
+            if fixed_clean.get((s, d), "").upper() == "A" and fixed_raw[(s, d)].endswith("↗"):
+                row[d + 1] -= NIGHT_SH
+
+        # day 0: Night only after a plain A; after a Night, OFF
+        prev_core, prev_arrow = str(prev_last7[s][6] or "").strip(), bool(prev_last7_arrow[s][6])
+        if prev_core in NIGHT_SH:
+            row[0] &= OFF
+        if not (prev_core == "A" and not prev_arrow):
+            row[0] -= NIGHT_SH
+        dom.append(row)
+    return dom
+
+def sequence_prescreen():
+    """Scan each staff row (last month's 7 days + this month's requests) once against
+    the Night sequence (A–N–O) rules; return the conflicts found. N spacing is a window rule."""
+    seqs = [(shift_bits(r["first"]), shift_bits(r["then"])) for r in rules_of("sequence") if not r.get("on")]
+    off_after = any(f & CLS_NIGHT and t & CLS_WORK for f, t in seqs)        # "off after night"
+    a_before  = any(t & CLS_NIGHT and not f & SHIFT_CLASS[SH_A] for f, t in seqs)   # "night after A"
+    problems = []
+    for s, name in enumerate(staff):
+        # per day d = -7 .. NUM_DAYS-1: is_night is forced; can_A / can_off still possible
+        is_night, can_A, can_off, code = {}, {}, {}, {}
+        for i, core in enumerate(prev_last7[s]):
+            d = i - 7
+            core = str(core or "").strip()
+            code[d]     = core
+            is_night[d] = core in NIGHT_SH
+            can_A[d]    = core == "A" and not prev_last7_arrow[s][i]
+            can_off[d]  = core in OFF
+        for d in range(NUM_DAYS):
+            if (s, d) not in fixed_clean:
+                is_night[d], can_A[d], can_off[d], code[d] = False, True, True, ""
+                continue
+            clean   = fixed_clean[(s, d)]
+            allowed = allowed_for_request(clean)
+            code[d]     = fixed_raw[(s, d)]
+            is_night[d] = allowed <= NIGHT_SH
+            can_A[d]    = "A" in allowed and not (clean.upper() == "A" and fixed_raw[(s, d)].endswith("↗"))
+            can_off[d]  = bool(allowed & OFF)
+
+        for d in range(-7, NUM_DAYS):
+            if d < 0:
+                if d == -1 and is_night[d] and not can_off[0] and off_after:
+                    problems.append(f"{name}: Night on {day_label(d)}, then {code[0]!r} on {day_label(0)} (must be OFF)")
+                continue
 
-    # exactly one of allowed…
-    model.Add(sum(X[s, d, t] for t in allowed) == 1)
-    # …and forbid everything else
-    for t in SHIFTS:
-        if t not in allowed:
-            model.Add(X[s, d, t] == 0)
-
-
-#### CONSTRAINTS ####
-
-
-
-# daily coverage & ≤3 Z2
-for d in range(NUM_DAYS):
-    am, pm, nt = cov_targets_per_day[d]
-    model.Add(sum(X[s,d,t] for s in range(NUM_STAFF) for t in AM_SH) == am)
-    model.Add(sum(X[s,d,t] for s in range(NUM_STAFF) for t in PM_SH) == pm)
-    model.Add(sum(X[s,d,t] for s in range(NUM_STAFF) for t in NIGHT_SH) == nt)
-    # model.Add(sum(X[s,d,"Z"] for s in range(NUM_STAFF)) <= 3)
+            if is_night[d]:
+                if not can_A[d - 1] and a_before:
+                    prev = code[d - 1] or "OFF"
+                    problems.append(f"{name}: Night on {day_label(d)} needs a plain A on {day_label(d - 1)}, "
+                                    f"found {prev!r}")
+                if d + 1 < NUM_DAYS and not can_off[d + 1] and off_after:
+                    problems.append(f"{name}: Night on {day_label(d)}, then {code[d + 1]!r} on "
+                                    f"{day_label(d + 1)} (must be OFF)")
+    return problems
+
+def window_prescreen():
+    """Scan each staff row against the window rules (e.g. ≤6 work days in any 7): days whose
+    request (or last month's duty) already falls in the rule's shifts, per window ending in this month."""
+    problems = []
+    for rule in rules_of("window"):
+        bits = shift_bits(rule["shifts"])
+        codes = {SHIFTS[k] for k in codes_of(bits)}
+        for s in rule_staff(rule):
+            length, limit = rule_value(rule, "length", s), rule_value(rule, "max", s)
+            if length is None or limit is None or length <= limit:
+                continue
+            forced = dict(zip(range(-7, 0), prev_flags(s, bits)))
+            for d in range(NUM_DAYS):
+                forced[d] = int((s, d) in fixed_clean and allowed_for_request(fixed_clean[(s, d)]) <= codes)
+            window, reported_to = sum(forced[d] for d in range(max(-length, -7), 0)), -8
+            for d in range(NUM_DAYS):
+                window += forced[d] - forced.get(d - length, 0)
+                if window > limit and d - length + 1 > reported_to:
+                    problems.append(f"{staff[s]}: {window} fixed days from {day_label(max(d - length + 1, -7))} "
+                                    f"to {day_label(d)} ({rule['name']}: max {limit} in {length})")
+                    reported_to = d
+    return problems
+
+def capacity_prescreen(dom):
+    """Return a list of violated counting bounds (empty if none)."""
+    problems = []
+    can  = lambda s, d, codes: bool(dom[s][d] & codes)
+    must = lambda s, d, codes: bool(dom[s][d]) and dom[s][d] <= codes
+
+    for s in range(NUM_STAFF):
+        for d in range(NUM_DAYS):
+            if not dom[s][d]:
+                problems.append(f"{day_label(d)}: {staff[s]} has no allowed shift "
+                                f"(request {fixed_clean.get((s, d), '-')!r})")
+
+    # --- Daily coverage: every union of AM / PM / Night against staff who can cover it ---
+    for d in range(NUM_DAYS) if rules_of("coverage") else ():
+        short, over = [], []
+        for mask in range(1, 1 << len(COVER_CLASSES)):
+            picked = [k for k in range(len(COVER_CLASSES)) if mask >> k & 1]
+            label  = "+".join(COVER_CLASSES[k][0] for k in picked)
+            codes  = set().union(*(COVER_CLASSES[k][1] for k in picked))
+            need   = sum(cov_targets_per_day[d][k] for k in picked)
+            n_can  = sum(can(s, d, codes) for s in range(NUM_STAFF))
+            n_must = sum(must(s, d, codes) for s in range(NUM_STAFF))
+            # only report the smallest failing unions
+            if need > n_can and not any(m & mask == m for m in short):
+                short.append(mask)
+                problems.append(f"{day_label(d)}: {label} needs {need}, only {n_can} staff available")
+            if n_must > need and not any(m & mask == m for m in over):
+                over.append(mask)
+                problems.append(f"{day_label(d)}: {n_must} staff fixed to {label}, coverage is {need}")
+
+    # --- Night quotas, and one N* and one N every day ---
+    for d in range(NUM_DAYS) if rules_of("night_quotas") else ():
+        nt = cov_targets_per_day[d][2]
+        if nt < 2:
+            problems.append(f"{day_label(d)}: Night coverage {nt} < 2 (one N* and one N per day)")
+        for t in ("N*", "N"):
+            if not any(t in dom[s][d] for s in range(NUM_STAFF)):
+                problems.append(f"{day_label(d)}: nobody can take {t}")
+            n_fixed = sum(dom[s][d] == {t} for s in range(NUM_STAFF))
+            if n_fixed > 1:
+                problems.append(f"{day_label(d)}: {n_fixed} staff fixed to {t}, only one allowed")
+
+    for t in ("N*", "N") if rules_of("night_quotas") else ():
+        total = sum(quotas[name][t] for name in staff)
+        if total != NUM_DAYS:
+            problems.append(f"{t} quotas add up to {total}, the month needs exactly {NUM_DAYS}")
+    total_nt = sum(c[2] for c in cov_targets_per_day)
+    total_q  = sum(quotas[name][t] for name in staff for t in NIGHT_SH)
+    if rules_of("night_quotas") and rules_of("coverage") and total_q != total_nt:
+        problems.append(f"N*/N/N3 quotas add up to {total_q}, Night coverage adds up to {total_nt}")
+    for s, name in enumerate(staff) if rules_of("night_quotas") else ():
+        for t in sorted(NIGHT_SH):
+            q = quotas[name][t]
+            n_can  = sum(t in dom[s][d] for d in range(NUM_DAYS))
+            n_must = sum(dom[s][d] == {t} for d in range(NUM_DAYS))
+            if q > n_can:
+                problems.append(f"{name}: {t} quota {q}, only {n_can} days allow it")
+            if n_must > q:
+                problems.append(f"{name}: {n_must} fixed {t}, quota is {q}")
+        q_all   = sum(quotas[name][t] for t in NIGHT_SH)
+        # the widest "at most one Night" window rule on this row
+        spacing = max([rule_value(r, "length", s) or 1 for r in rules_of("window")
+                       if shift_bits(r["shifts"]) == CLS_NIGHT and rule_value(r, "max", s) == 1
+                       and s in rule_staff(r)], default=1)
+        if q_all and (q_all - 1) * spacing + 1 > NUM_DAYS:
+            problems.append(f"{name}: {q_all} nights at spacing {spacing} do not fit in {NUM_DAYS} days")
+
+    # --- Rank groups in the rank_mix rules (bounds clamped to coverage, as in the model) ---
+    mixed = {g for rule in rules_of("rank_mix") for g in rule["groups"]}
+    groups = [(label, idx, key) for label, idx, key in (
+              ("Senior", senior_idx, "senior"), ("Junior", junior_idx, "junior"),
+              ("CON+AC", conac_idx, "conac"), ("AC", ac_idx, "ac"), ("HT", ht_idx, "ht"),
+              ("BT", bt_idx, "bt"), ("E", e_idx, "e")) if key in mixed]
+    for d in range(NUM_DAYS):
+        am_cov, pm_cov, _ = cov_targets_per_day[d]
+        for label, idx, key in groups:
+            minA, maxA, minP, maxP = roster.rank_mix[key][:, d].tolist()
+            a_min, a_max = min(minA, am_cov), min(maxA, am_cov)
+            p_min, p_max = min(minP, pm_cov), min(maxP, pm_cov)
+            for sh, lo, hi in (("A", a_min, a_max), ("P", p_min, p_max)):
+                n_can  = sum(can(s, d, {sh}) for s in idx)
+                n_must = sum(must(s, d, {sh}) for s in idx)
+                if lo > n_can:
+                    problems.append(f"{day_label(d)}: {label} {sh} ≥ {lo}, only {n_can} of {len(idx)} available")
+                if n_must > hi:
+                    problems.append(f"{day_label(d)}: {label} {sh} ≤ {hi}, but {n_must} fixed to {sh}")
+            n_can = sum(can(s, d, AM_SH | PM_SH) for s in idx)
+            if a_min and p_min and a_min + p_min > n_can:
+                problems.append(f"{day_label(d)}: {label} A ≥ {a_min} and P ≥ {p_min}, "
+                                f"only {n_can} of {len(idx)} available")
+
+        specialists = [s for s, r in enumerate(ranks) if r.upper().startswith(("CON1", "CON2", "CON3", "AC"))]
+        if d < NUM_DAYS - 1 and not any(can(s, d, AM_SH) for s in specialists):
+            problems.append(f"{day_label(d)}: no shift specialist (CON1-3 / AC) available for A")
+
+    # --- daily_count minimums (e.g. an HT on A every weekend / holiday) ---
+    for rule in rules_of("daily_count"):
+        codes = {SHIFTS[k] for k in codes_of(shift_bits(rule["shifts"]))}
+        rows = rule_staff(rule)
+        for d in rule_days(rule):
+            n_can = sum(can(s, d, codes) for s in rows)
+            if rule.get("min", 0) > n_can:
+                problems.append(f"{day_label(d)}: {rule['name']} needs {rule['min']}, only {n_can} staff available")
+
+    # --- quota rules (SUN-Off / WE-Off / SUN P, ...) against the days the month actually has;
+    # rules counting the same shifts on the same days are checked together ---
+    bounds = {}   # (staff, shift bits, days) -> [lo, hi, rule names]
+    for rule in rules_of("quota"):
+        key = (shift_bits(rule["shifts"]), tuple(rule_days(rule)))
+        for s in rule_staff(rule):
+            lo, hi = rule_value(rule, "min", s), rule_value(rule, "max", s)
+            if lo is None and hi is None:
+                continue
+            b = bounds.setdefault((s,) + key, [0, len(key[1]), []])
+            b[0], b[1] = max(b[0], lo or 0), min(b[1], len(key[1]) if hi is None else hi)
+            b[2].append(rule["name"])
+    for (s, bits, days), (lo, hi, names) in bounds.items():
+        codes = {SHIFTS[k] for k in codes_of(bits)}
+        label = " / ".join(names)
+        n_can  = sum(can(s, d, codes) for d in days)
+        n_must = sum(must(s, d, codes) for d in days)
+        if lo > n_can:
+            problems.append(f"{staff[s]}: {label} needs {lo}, only {n_can} of {len(days)} days allow it")
+        elif lo > hi:
+            problems.append(f"{staff[s]}: {label}: at least {lo} and at most {hi}")
+        elif n_must > hi:
+            problems.append(f"{staff[s]}: {label} at most {hi}, but {n_must} are fixed")
+    return problems
+
+
+# dom[s][d]: the shifts each cell can still take (requests, fixed-only codes, COS/CON rows, ...)
+cell_dom = cell_domains()
+
+if not args.no_precheck:
+    _problems = sequence_prescreen() + window_prescreen() + capacity_prescreen(cell_dom)
+    if _problems:
+        print(f"❌ Pre-check: {len(_problems)} problem(s), the roster cannot be feasible:")
+        for p in _problems:
+            print(f"   • {p}")
+        sys.exit(1)
+
+
+# === 2.1a Constraint registry: rule-family provenance + de-duplication ===
+# registry.family("name") marks where a rule family starts; every variable and
+# constraint added until the next mark belongs to it. registry.finalize() drops
+# constraints that are identical after canonicalisation (term order, merged
+# coefficients, enforcement order) and keeps per-family size / build-time stats.
+# Constraints added inside a @registry.defines helper only define a variable (a shift-class
+# literal, a conjunction, a prefix count); --diagnose keeps those hard and guards the rest.
+class ModelRegistry:
+    def __init__(self, model):
+        self.model = model
+        self.marks = []    # (family, first constraint index, first variable index, start time)
+        self.stats = {}    # family -> {"vars", "cons", "dups", "secs"}
+        self.def_ranges = []   # (first, end) constraint indices added by @defines helpers
+        self.tags = []     # per kept constraint after finalize(): (family, defines a variable?)
+
+    def defines(self, fn):
+        """Decorator: the constraints fn adds define variables rather than state a rule."""
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            first = len(self.model.Proto().constraints)
+            try:
+                return fn(*a, **kw)
+            finally:
+                self.def_ranges.append((first, len(self.model.Proto().constraints)))
+        return wrapper
+
+    def family(self, name):
+        proto = self.model.Proto()
+        self.marks.append((name, len(proto.constraints), len(proto.variables), time.perf_counter()))
+
+    @staticmethod
+    def _key(ct):
+        enf = tuple(sorted(ct.enforcement_literal))
+        kind = ct.WhichOneof("constraint")
+        if kind == "linear":
+            terms = {}
+            for v, k in zip(ct.linear.vars, ct.linear.coeffs):
+                terms[v] = terms.get(v, 0) + k
+            terms = tuple(sorted((v, k) for v, k in terms.items() if k))
+            return kind, enf, terms, tuple(ct.linear.domain)
+        if kind in ("bool_or", "bool_and", "at_most_one", "exactly_one"):
+            return kind, enf, tuple(sorted(getattr(ct, kind).literals))
+        return kind, enf, ct.SerializeToString(deterministic=True)
+
+    def finalize(self):
+        """Drop duplicate constraints from the model; fill self.stats. Call once, before solving."""
+        proto = self.model.Proto()
+        now = time.perf_counter()
+        bounds = self.marks + [(None, len(proto.constraints), len(proto.variables), now)]
+        is_def = np.zeros(len(proto.constraints), dtype=bool)
+        for c0, c1 in self.def_ranges:
+            is_def[c0:c1] = True
+        seen, kept = set(), []
+        for (name, c0, v0, t0), (_, c1, v1, t1) in zip(bounds, bounds[1:]):
+            st = self.stats.setdefault(name, {"vars": 0, "cons": 0, "dups": 0, "secs": 0.0})
+            st["vars"] += v1 - v0
+            st["secs"] += t1 - t0
+            for i in range(c0, c1):
+                key = self._key(proto.constraints[i])
+                if key in seen:
+                    st["dups"] += 1
+                    continue
+                seen.add(key)
+                kept.append(proto.constraints[i])
+                self.tags.append((name, bool(is_def[i])))
+                st["cons"] += 1
+        if len(kept) < len(proto.constraints):
+            new = type(proto)()
+            new.CopyFrom(proto)
+            del new.constraints[:]
+            new.constraints.extend(kept)
+            proto.CopyFrom(new)
+        return self.stats
+
+    def report(self):
+        print(f"{'family':<22}{'vars':>8}{'cons':>8}{'dups':>7}{'build s':>9}")
+        for name, st in self.stats.items():
+            print(f"{name:<22}{st['vars']:>8}{st['cons']:>8}{st['dups']:>7}{st['secs']:>9.2f}")
+        tot = {k: sum(st[k] for st in self.stats.values()) for k in ("vars", "cons", "dups", "secs")}
+        print(f"{'total':<22}{tot['vars']:>8}{tot['cons']:>8}{tot['dups']:>7}{tot['secs']:>9.2f}")
+
+
+# === 2.1b Detector index ===
+# Pattern detectors (PA, PAN, PPP, PPPP, spec_ok) keyed by (family, staff, day), where day is
+# the day the pattern is counted on (its last day, e.g. the A of P→A). Caps, objective and
+# statistics look them up here instead of scanning variable names.
+class DetectorIndex:
+    def __init__(self):
+        self.by_key = {}
+        self.by_family = {}
+        self.by_staff = {}
+        self.by_day = {}
+
+    def add(self, family, s, d, var):
+        """Register var as the (family, s, d) detector; an existing one is kept and returned."""
+        key = (family, s, d)
+        if key in self.by_key:
+            return self.by_key[key]
+        self.by_key[key] = var
+        self.by_family.setdefault(family, []).append(var)
+        self.by_staff.setdefault((family, s), []).append(var)
+        self.by_day.setdefault((family, d), []).append(var)
+        return var
+
+    def get(self, family, s, d, default=None):
+        return self.by_key.get((family, s, d), default)
+
+    def family(self, family):
+        return self.by_family.get(family, [])
+
+    def for_staff(self, family, s):
+        return self.by_staff.get((family, s), [])
+
+    def on_day(self, family, d):
+        return self.by_day.get((family, d), [])
+
+
+# === 2.1c Bulk proto writer ===
+# The dense families (decision variables, day counters, one shift/day, coverage, rank / senior
+# mix, night quotas, hours and P/A ratio) are sums over whole [staff, day, shift] slices. Their
+# variable indices are computed as NumPy arrays and appended straight to the CpModelProto's
+# repeated fields, instead of one model.Add() and LinearExpr tree per constraint.
+# A term table is an (rows, terms) array of variable indices, -1 marking a term that is the
+# constant in the matching value table; constants are folded into the constraint bounds.
+class BulkProto:
+    def __init__(self, model):
+        self.proto = model.Proto()
+
+    def new_vars(self, names, lo, hi):
+        """Append one variable per name with domain [lo, hi] (scalars or per-name arrays); returns their indices."""
+        start = len(self.proto.variables)
+        lo = np.broadcast_to(lo, len(names)).tolist()
+        hi = np.broadcast_to(hi, len(names)).tolist()
+        add = self.proto.variables.add
+        for name, a, b in zip(names, lo, hi):
+            add(name=name, domain=(a, b))
+        return np.arange(start, start + len(names), dtype=np.int64)
+
+    def wrap(self, idx):
+        """IntVar handles for existing variable indices, for the rules still written with model.Add()."""
+        return [cp_model.IntVar(self.proto, i, None) for i in np.asarray(idx).tolist()]
+
+    @staticmethod
+    def _rows(idx, mask):
+        # flatten the kept terms once, then slice them per row
+        ends = np.cumsum(mask.sum(axis=1)).tolist()
+        return zip([0] + ends[:-1], ends)
+
+    def add_linear(self, idx, val, coef, lo=None, hi=None):
+        """One constraint per row r: lo[r] <= sum_k coef[r,k] * term[r,k] <= hi[r] (None = unbounded).
+        A row left without variables is dropped if its constants already satisfy it, else kept
+        as an empty (infeasible) constraint; lo > hi is split into two one-sided constraints."""
+        idx = np.asarray(idx, dtype=np.int64)
+        coef = np.broadcast_to(np.asarray(coef, dtype=np.int64), idx.shape)
+        const = np.where(idx < 0, np.broadcast_to(val, idx.shape) * coef, 0).sum(axis=1).tolist()
+        n = idx.shape[0]
+        lo = [None] * n if lo is None else np.broadcast_to(lo, n).tolist()
+        hi = [None] * n if hi is None else np.broadcast_to(hi, n).tolist()
+        mask = (idx >= 0) & (coef != 0)
+        terms, coeffs = idx[mask].tolist(), coef[mask].tolist()
+        cons = self.proto.constraints
+        for (i, j), c, a, b in zip(self._rows(idx, mask), const, lo, hi):
+            a = cp_model.INT_MIN if a is None else int(a) - c
+            b = cp_model.INT_MAX if b is None else int(b) - c
+            if i == j and a <= 0 <= b:
+                continue
+            for dom in ([(a, b)] if a <= b else [(a, cp_model.INT_MAX), (cp_model.INT_MIN, b)]):
+                lin = cons.add().linear
+                lin.vars.extend(terms[i:j])
+                lin.coeffs.extend(coeffs[i:j])
+                lin.domain.extend(dom)
+
+    def add_exactly_one(self, idx):
+        """One ExactlyOne per row over its variables (-1 entries are constant-0 terms and dropped)."""
+        idx = np.asarray(idx, dtype=np.int64)
+        mask = idx >= 0
+        lits = idx[mask].tolist()
+        cons = self.proto.constraints
+        for i, j in self._rows(idx, mask):
+            cons.add().exactly_one.literals.extend(lits[i:j])
+
+
+# === 2.1 Decision variables, only for shifts the cell's domain allows ===
+# Forbidden shifts are the constant 0 and a single-shift cell is the constant 1, so the
+# rest of the model can keep indexing X[s, d, k] for every shift code. This replaces the old
+# X == 0 pins for SPECIAL_FIXED_ONLY, the request overrides and the COS / CON1-2 rows.
+# Rows where every cell has a single shift (e.g. COS staff) are presolved out: their X entries
+# are plain 0/1 ints, so coverage, rank mix and every other sum folds them into its bounds as
+# constants, their own rules reduce to constant checks, and Output1 reads them back from X.
+FIXED_ROWS = [s for s in range(NUM_STAFF) if all(len(dom) == 1 for dom in cell_dom[s])]
+if FIXED_ROWS:
+    print(f"➡️  {len(FIXED_ROWS)} fixed staff row(s) presolved out: {', '.join(staff[s] for s in FIXED_ROWS)}")
 
-# --- Avoid PM→PM across Saturday→Sunday ---
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS-1):
-        if weekdays[d]=="SAT" and weekdays[d+1]=="SUN":
-            # at most one PM in that pair
-            for t in PM_SH:
-                model.Add(X[s,d,t] + X[s,d+1,t] <= 1)
-
-# --- Count 3-consecutive PM runs ---
-three_pm = []
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS-2):
-        v = model.NewBoolVar(f"pm3_{s}_{d}")
-        # v == 1 ↔ staff s has PM on d,d+1,d+2
-        model.AddBoolAnd([X[s,d,t] for t in PM_SH] +
-                         [X[s,d+1,t] for t in PM_SH] +
-                         [X[s,d+2,t] for t in PM_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s,d,t].Not() for t in PM_SH] +
-                        [X[s,d+1,t].Not() for t in PM_SH] +
-                        [X[s,d+2,t].Not() for t in PM_SH] +
-                        [v])
-        three_pm.append(v)
-
-# --- Count 4-consecutive PM runs ---
-four_pm = []
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS - 3):
-        v = model.NewBoolVar(f"pm4_{s}_{d}")
-        model.AddBoolAnd([X[s, d+k, t] for k in range(4) for t in PM_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, d+k, t].Not() for k in range(4) for t in PM_SH] + [v])
-        four_pm.append(v)
-
-# --- Count PM→AM→Night chains ---
-pm_am_n = []
+model = cp_model.CpModel()
+registry = ModelRegistry(model)
+bulk = BulkProto(model)
+registry.family("decision vars")
+detectors = DetectorIndex()
+# Dense tables, indexed [s, d, k] with k the shift code: X holds the decision literal (or its
+# constant), XI the variable index (-1 where the cell is a constant) and XV the constant's value.
+dom_mask = np.zeros((NUM_STAFF, NUM_DAYS, len(SHIFTS)), dtype=bool)
 for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS-2):
-        v = model.NewBoolVar(f"chain_{s}_{d}")
-        model.AddBoolAnd(
-            [X[s,d,t] for t in PM_SH] +
-            [X[s,d+1,t] for t in AM_SH] +
-            [X[s,d+2,t] for t in NIGHT_SH]
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [x.Not() for x in ([X[s,d,t] for t in PM_SH] +
-                               [X[s,d+1,t] for t in AM_SH] +
-                               [X[s,d+2,t] for t in NIGHT_SH])] + [v]
-        )
-        pm_am_n.append(v)
-        
-# quotas & one N*/day
-for s,name in enumerate(staff):
-    model.Add(sum(X[s,d,"N*"] for d in range(NUM_DAYS)) == quotas[name]["N*"])
-    model.Add(sum(X[s,d,"N"]   for d in range(NUM_DAYS)) == quotas[name]["N"])
-    model.Add(sum(X[s,d,"N3"]   for d in range(NUM_DAYS)) == quotas[name]["N3"])
-#    model.Add(sum(X[s,d,"Z"]  for d in range(NUM_DAYS)) == quotas[name]["Z"])
-for d in range(NUM_DAYS):
-    model.Add(sum(X[s,d,"N*"] for s in range(NUM_STAFF)) == 1)
-    model.Add(sum(X[s,d,"N"] for s in range(NUM_STAFF)) == 1)
-   
-# --- Exact SUN-Off & WE-Off quotas (only if given) ---
-for s, name in enumerate(staff):
-    sun_req = quotas[name]["SUN-Off"]
-    we_req  = quotas[name]["WE-Off"]
-
-    if sun_req is not None:
-        # exactly sun_req OFF (any code in OFF) on Sundays
-        model.Add(
-            sum(
-                sum(X[s, d, t] for t in OFF)
-                for d, wd in enumerate(weekdays)
-                if wd == "SUN"
-            ) == sun_req
-        )
-
-    if we_req is not None:
-        # exactly we_req OFF on any WE‐type day (weekend/holiday)
-        model.Add(
-            sum(
-                sum(X[s, d, t] for t in OFF)
-                for d in range(NUM_DAYS)
-                if day_type[d] == "WE"
-            ) == we_req
-        )
-
-
-# === Adjacency & N-spacing (FORBID Night after A↗) ===
-# Uses: OFF, NIGHT_SH, fixed_raw, fixed_clean, prev_last7, prev_last7_arrow
+    for d in range(NUM_DAYS):
+        dom_mask[s, d, [SHIFT_CODE[t] for t in cell_dom[s][d]]] = True
+dom_size = dom_mask.sum(axis=2)
+x_free = dom_mask & (dom_size > 1)[:, :, None]
+XV = (dom_mask & ~x_free).astype(np.int64)
+XI = np.full(dom_mask.shape, -1, dtype=np.int64)
+XI[x_free] = bulk.new_vars([f"x_{s}_{d}_{SHIFTS[k]}" for s, d, k in np.argwhere(x_free).tolist()], 0, 1)
+
+X = np.empty(dom_mask.shape, dtype=object)
+x_zero, x_one = model.NewConstant(0), model.NewConstant(1)
+X[:] = np.where(XV == 1, x_one, x_zero)
+X[FIXED_ROWS] = XV[FIXED_ROWS]            # presolved rows: plain ints
+x_vars = np.empty(int(x_free.sum()), dtype=object)
+x_vars[:] = bulk.wrap(XI[x_free])
+X[x_free] = x_vars
+
+def x_rows(codes, per, staff_idx=None):
+    """Term tables (XI, XV) of X over the shift codes `codes`: one row per day summing over
+    staff_idx (default: everyone), or per="staff" for one row per staff summing over the month."""
+    rows = range(NUM_STAFF) if staff_idx is None else sorted(staff_idx)
+    sel = np.ix_(list(rows), range(NUM_DAYS), list(codes))
+    idx, val = XI[sel], XV[sel]
+    if per == "day":
+        idx, val = idx.transpose(1, 0, 2), val.transpose(1, 0, 2)
+    shape = (idx.shape[0], idx.shape[1] * idx.shape[2])
+    return idx.reshape(shape), val.reshape(shape)
+
+registry.family("day counters")
+# === 2.1d Shift-class literal cache, per-staff day indicators and prefix counts ===
+# shift_lit(s, d, cls) is "staff s works a shift of class cls (CLS_* bitmask) on day d". It is built at most
+# once per (staff, day, class) and shared by every rule: an int when the cell's domain (or,
+# for d < 0, last month's tail) already decides it, the X literal itself for a one-shift class,
+# else a single BoolVar channelled to the sum of X. all_of() does the same for conjunctions,
+# so a pattern such as P→A→N is one literal however many rules read it.
+# is_work / is_night / is_pm [s][d] are the per-day indicators; cnt_*[s][k] counts those days
+# among days 0 .. k-1, so the days in [a, b) are cnt[s][b] - cnt[s][a]: each sliding-window rule
+# is then one two-term constraint per window instead of window length × shifts terms.
+_shift_lits, _and_lits = {}, {}
 
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS - 1):
-        # 1) After any night, next day must be OFF
-        for nt in NIGHT_SH:
-            model.Add(sum(X[s, d+1, t] for t in OFF) == 1).OnlyEnforceIf(X[s, d, nt])
-
-        # 2) If today is a fixed A↗, FORBID Night tomorrow
-        is_fixed_A_arrow = (
-            (s, d) in fixed_raw
-            and str(fixed_clean[(s, d)]).strip().upper() == "A"
-            and str(fixed_raw[(s, d)]).endswith("↗")
-        )
-        if is_fixed_A_arrow:
-            model.Add(sum(X[s, d+1, nt] for nt in NIGHT_SH) == 0)
-        else:
-            # Otherwise: if tomorrow is Night, today must be plain A
-            for nt in NIGHT_SH:
-                model.Add(X[s, d, "A"] == 1).OnlyEnforceIf(X[s, d+1, nt])
-
-    # === Cross-month adjacency (day -1 → day 0) ===
-    prev_core  = str(prev_last7[s][6] or "").strip()
-    prev_arrow = bool(prev_last7_arrow[s][6])
-
-    # If last day of last month was a Night, day 0 must be OFF
-    if prev_core in NIGHT_SH:
-        model.Add(sum(X[s, 0, t] for t in OFF) == 1)
-
-    # If last day of last month was A↗, FORBID Night on day 0
-    if (prev_core == "A") and prev_arrow:
-        for nt in NIGHT_SH:
-            model.Add(X[s, 0, nt] == 0)
+def _norm(code: object) -> str:
+    # normalize prior-month codes such as "A↗", "P*" → "A","P"
+    return str(code or "").strip().rstrip("↗").rstrip("*")
+
+# class bits of last month's days -7 .. -1 (index 7 + d), after normalising
+PREV_CLS = np.array([[code_class(_norm(c)) for c in prev_last7[s]] for s in range(NUM_STAFF)],
+                    dtype=np.int64).reshape(NUM_STAFF, 7)
+
+@registry.defines
+def shift_lit(s, d, cls, name="cls"):
+    key = (s, d, cls)
+    if key in _shift_lits:
+        return _shift_lits[key]
+    if d < 0:
+        lit = int(d >= -7 and bool(PREV_CLS[s, 7 + d] & cls))
     else:
-        # Otherwise: allow Night on day 0 only if yesterday was plain A
-        is_prev_A_plain = (prev_core == "A" and not prev_arrow)
-        if not is_prev_A_plain:
-            for nt in NIGHT_SH:
-                model.Add(X[s, 0, nt] == 0)
-
-    # === N-spacing (min interval between nights), includes cross-day within month
-    name = staff[s]
-    indiv_spacing = int(quotas[name].get("Nspacing", 0))
-    spacing = max(indiv_spacing, global_Nspacing)
-
-    if spacing > 1:
-        for d1 in range(NUM_DAYS):
-            stop = min(d1 + spacing, NUM_DAYS)  # nights forbidden on d2 in (d1, stop)
-            for d2 in range(d1 + 1, stop):
-                model.Add(
-                    sum(X[s, d1, nt] for nt in NIGHT_SH) +
-                    sum(X[s, d2, nt] for nt in NIGHT_SH)
-                    <= 1
-                )
-
-
-# === N spacing including cross-month boundary ===
-for s in range(NUM_STAFF):
-    name = staff[s]
-    indiv_spacing = int(quotas[name].get("Nspacing", 0))   # per-doctor (col I)
-    spacing = max(indiv_spacing, global_Nspacing)
-
-    if spacing > 1:
-        # 1) Intra-month: already implemented
-        for d1 in range(NUM_DAYS):
-            stop = min(d1 + spacing, NUM_DAYS)
-            for d2 in range(d1 + 1, stop):
-                model.Add(
-                    sum(X[s, d1, nt] for nt in NIGHT_SH) +
-                    sum(X[s, d2, nt] for nt in NIGHT_SH)
-                    <= 1
-                )
-
-        # 2) Cross-month: check last 7 days of previous month
-        for offset, prev_core in enumerate(prev_last7[s]):
-            if str(prev_core).strip() in NIGHT_SH:
-                prev_day_index = -7 + offset  # -7 .. -1
-
-                # distance into this month must respect spacing
-                for d in range(min(spacing, NUM_DAYS)):
-                    # day index in this month
-                    if d < spacing - abs(prev_day_index):   # ensure correct gap
-                        for nt in NIGHT_SH:
-                            model.Add(X[s, d, nt] == 0)
-                            
-# COS: follow original requests only (no auto-assignment)
-for s, name in enumerate(staff):
-    if ranks[s].upper().startswith("COS"):
-        for d in range(NUM_DAYS):
-            if (s, d) in fixed_clean:
-                # Prefilled request already enforced by your fixed-override logic.
-                # Do not add anything here to avoid conflicts.
-                pass
-            else:
-                 # No request -> force an OFF-type shift (any of OFF set)
-                 model.Add(sum(X[s, d, t] for t in OFF) == 1)
-                 for t in set(SHIFTS) - OFF:
-                    model.Add(X[s, d, t] == 0)
-
-# CON1 & CON2, weekly Z <= 3  (prefill-aware; OFF includes ☆)
-# Make sure OFF is defined earlier like: OFF = {"O","AL","☆","½●½O","兒","父" "SH","PH"}
-for s, name in enumerate(staff):
-    if ranks[s].upper().startswith(("CON1", "CON2")):
-        for d in range(NUM_DAYS):
-            # If a duty was prefilled for this (staff, day), let that override entirely.
-            if (s, d) in fixed_clean:
-                continue  # prefilled logic already enforced elsewhere
-
-            if day_type[d] == "WE":
-                # Weekend/holiday must be OFF (any OFF subtype allowed, incl ☆)
-                model.Add(sum(X[s, d, t] for t in OFF) == 1)
-                # Forbid any non-OFF on WE
-                for t in set(SHIFTS) - OFF:
-                    model.Add(X[s, d, t] == 0)
+        hit = np.flatnonzero(dom_mask[s, d] & ((SHIFT_CLASS & cls) != 0)).tolist()
+        if not hit:
+            lit = 0
+        elif len(hit) == dom_size[s, d]:
+            lit = 1
+        elif len(hit) == 1:
+            lit = X[s, d, hit[0]]
+        else:
+            lit = model.NewBoolVar(f"{name}_{s}_{d}")
+            model.Add(lit == sum(X[s, d, k] for k in hit))
+    _shift_lits[key] = lit
+    return lit
+
+def lit_not(lit):
+    return 1 - lit if isinstance(lit, int) else lit.Not()
+
+def off_lit(s, d):
+    # one shift per cell, so OFF is "not working"
+    return lit_not(shift_lit(s, d, CLS_WORK, "work"))
+
+@registry.defines
+def all_of(lits, name):
+    """1 iff every literal is 1. Constants are folded; each conjunction is built once."""
+    lits = [l for l in lits if not (isinstance(l, int) and l == 1)]
+    if any(isinstance(l, int) for l in lits):
+        return 0
+    if not lits:
+        return 1
+    if len(lits) == 1:
+        return lits[0]
+    key = tuple(sorted({l.Index() for l in lits}))
+    if key not in _and_lits:
+        v = model.NewBoolVar(name)
+        model.AddBoolAnd(lits).OnlyEnforceIf(v)
+        model.AddBoolOr([lit_not(l) for l in lits] + [v])
+        _and_lits[key] = v
+    return _and_lits[key]
+
+@registry.defines
+def class_lits(cls, name):
+    """shift_lit(s, d, cls) for every cell, built in bulk; returns the literal grid [s][d] plus
+    its term tables (index, value), and fills the cache so later shift_lit calls are lookups."""
+    hit = dom_mask & ((SHIFT_CLASS & cls) != 0)
+    n_hit = hit.sum(axis=2)
+    chan = (n_hit > 1) & (n_hit < dom_size)
+    one = (n_hit == 1) & (dom_size > 1)                 # the X literal of its single shift
+    first = hit.argmax(axis=2)
+    LI = np.where(one, np.take_along_axis(XI, first[:, :, None], axis=2)[:, :, 0], -1)
+    LV = ((n_hit > 0) & (n_hit == dom_size)).astype(np.int64)
+    # channel: lit - sum(X over the hit shifts) == 0
+    LI[chan] = bulk.new_vars([f"{name}_{s}_{d}" for s, d in np.argwhere(chan).tolist()], 0, 1)
+    terms = np.where(hit[chan], XI[chan], -1)
+    bulk.add_linear(np.concatenate([LI[chan][:, None], terms], axis=1), 0,
+                    np.concatenate([[1], np.full(len(SHIFTS), -1)]), 0, 0)
+    chan_vars = iter(bulk.wrap(LI[chan]))
+    grid = []
+    for s, (lv_row, ch_row, one_row, k_row) in enumerate(zip(LV.tolist(), chan.tolist(), one.tolist(), first.tolist())):
+        row = []
+        for d, (v, ch, single, k) in enumerate(zip(lv_row, ch_row, one_row, k_row)):
+            if ch:
+                lit = next(chan_vars)
+            elif single:
+                lit = X[s, d, k]
             else:
-                # On non-WE days, allow only A, Z, or OFF; forbid everything else
-                allowed = {"A", "Z"} | OFF
-                for t in set(SHIFTS) - allowed:
-                    model.Add(X[s, d, t] == 0)
+                lit = v
+            _shift_lits[s, d, cls] = lit
+            row.append(lit)
+        grid.append(row)
+    return grid, LI, LV
+
+@registry.defines
+def prefix_counts(LI, LV, name):
+    """cnt[s][k] = flagged days among days 0 .. k-1, for every staff row. A prefix that is still all
+    constants stays an int; from the first variable day on, cnt[k+1] == cnt[k] + lit[k]."""
+    var_from = np.cumsum(LI >= 0, axis=1) > 0          # cnt[s][d+1] needs a variable
+    CI = np.full((NUM_STAFF, NUM_DAYS + 1), -1, dtype=np.int64)
+    cells = np.argwhere(var_from)
+    CI[:, 1:][var_from] = bulk.new_vars([f"{name}_{s}_{d + 1}" for s, d in cells.tolist()], 0, cells[:, 1] + 1)
+    CV = np.concatenate([np.zeros((NUM_STAFF, 1), dtype=np.int64), np.cumsum(LV, axis=1)], axis=1)
+    s, d = cells[:, 0], cells[:, 1]
+    bulk.add_linear(np.stack([CI[s, d + 1], CI[s, d], LI[s, d]], axis=1),
+                    np.stack([np.zeros_like(d), CV[s, d], LV[s, d]], axis=1), [1, -1, -1], 0, 0)
+    cnt_vars = iter(bulk.wrap(CI[CI >= 0]))
+    return [[next(cnt_vars) if i >= 0 else v for i, v in zip(ci_row, cv_row)]
+            for ci_row, cv_row in zip(CI.tolist(), CV.tolist())]
+
+def count_terms(cnt):
+    """Term tables (index, value) of one staff row of prefix counts."""
+    idx = np.array([-1 if isinstance(c, int) else c.Index() for c in cnt], dtype=np.int64)
+    val = np.array([c if isinstance(c, int) else 0 for c in cnt], dtype=np.int64)
+    return idx, val
+
+def cap_windows(cnt, prev_flags, length, limit):
+    """At most `limit` flagged days in every `length`-day window that ends in this month.
+    prev_flags (last month's days -7 .. -1) count towards windows that start before day 0;
+    if last month alone already reaches the limit, the month part of the window must be 0."""
+    idx, val = count_terms(cnt)
+    ends = np.arange(1, NUM_DAYS + 1)
+    cap = []
+    for end in ends.tolist():
+        start = end - length
+        prev_cnt = sum(prev_flags[max(7 + start, 0):]) if start < 0 else 0
+        cap.append(max(limit - prev_cnt, 0))
+    # cnt[end] - cnt[max(start, 0)] <= cap, one row per window
+    cols = np.stack([ends, np.maximum(ends - length, 0)], axis=1)
+    bulk.add_linear(idx[cols], val[cols], [1, -1], hi=cap)
+
+is_work,  work_li,  work_lv  = class_lits(CLS_WORK,  "work")
+is_night, night_li, night_lv = class_lits(CLS_NIGHT, "night")
+is_pm,    pm_li,    pm_lv    = class_lits(CLS_PM,    "pm")
+cnt_work  = prefix_counts(work_li,  work_lv,  "cnt_work")
+cnt_night = prefix_counts(night_li, night_lv, "cnt_night")
+cnt_pm    = prefix_counts(pm_li,    pm_lv,    "cnt_pm")
+
+
+# === 2.1e Rule compiler (RULES, see "Rule spec") ===
+# Each rule becomes its own family, written by the bulk builders above: a shift selection is
+# one class bitmask, its per-cell literals and prefix counts are built once (the work / night /
+# PM ones are those above) and shared by every rule that selects the same shifts.
+_sel_lits = {CLS_WORK: (work_li, work_lv), CLS_NIGHT: (night_li, night_lv), CLS_PM: (pm_li, pm_lv)}
+_sel_cnts = {CLS_WORK: cnt_work, CLS_NIGHT: cnt_night, CLS_PM: cnt_pm}
+
+def sel_lits(bits):
+    """Term tables (LI, LV) [s, d] of 'works a shift in bits', built once per selection."""
+    if bits not in _sel_lits:
+        _, LI, LV = class_lits(bits, f"sel{bits}")
+        _sel_lits[bits] = LI, LV
+    return _sel_lits[bits]
+
+def sel_counts(bits):
+    if bits not in _sel_cnts:
+        _sel_cnts[bits] = prefix_counts(*sel_lits(bits), f"cnt_sel{bits}")
+    return _sel_cnts[bits]
+
+def _cells(rows, days):
+    # np.ix_ that stays an integer index when a list is empty
+    return np.ix_(np.asarray(rows, dtype=np.int64), np.asarray(days, dtype=np.int64))
+
+def compile_coverage(rule):
+    for col, cls in enumerate((CLS_AM, CLS_PM, CLS_NIGHT)):
+        bulk.add_linear(*x_rows(codes_of(cls), "day"), 1, COV[:, col], COV[:, col])
+
+def compile_rank_mix(rule):
+    for group in rule["groups"]:
+        _enforce_group_minmax(RANK_GROUPS[group], *roster.rank_mix[group])
+
+def compile_night_quotas(rule):
+    for t in ("N*", "N", "N3"):
+        quota = [quotas[name][t] for name in staff]
+        bulk.add_linear(*x_rows([SHIFT_CODE[t]], "staff"), 1, quota, quota)
+    for t in ("N*", "N"):
+        bulk.add_linear(*x_rows([SHIFT_CODE[t]], "day"), 1, 1, 1)
+
+def compile_window(rule):
+    bits = shift_bits(rule["shifts"])
+    cnt = sel_counts(bits)
+    for s in rule_staff(rule):
+        length, limit = rule_value(rule, "length", s), rule_value(rule, "max", s)
+        if length is not None and limit is not None and length > limit:   # else it cannot bind
+            cap_windows(cnt[s], prev_flags(s, bits), length, limit)
+
+def compile_weekly_cap(rule):
+    # 7-day blocks from the first week_start day (days before it are not capped)
+    bits, rows = shift_bits(rule["shifts"]), rule_staff(rule)
+    first = weekdays.index(rule["week_start"]) if rule.get("week_start") in weekdays else 0
+    starts = np.arange(first, NUM_DAYS, 7)
+    ends = np.minimum(starts + 7, NUM_DAYS)
+    if bits in _sel_cnts:   # prefix counts already built: cnt[end] - cnt[start], two terms a block
+        for s in rows:
+            idx, val = count_terms(_sel_cnts[bits][s])
+            cols = np.stack([ends, starts], axis=1)
+            bulk.add_linear(idx[cols], val[cols], [1, -1], hi=rule["max"])
+        return
+    LI, LV = sel_lits(bits)
+    days = np.arange(NUM_DAYS)
+    block = (days >= starts[:, None]) & (days < ends[:, None])          # [block, day]
+    idx = np.where(block, LI[rows][:, None, :], -1).reshape(-1, NUM_DAYS)
+    val = np.where(block, LV[rows][:, None, :], 0).reshape(-1, NUM_DAYS)
+    bulk.add_linear(idx, val, 1, hi=rule["max"])
+
+def compile_sequence(rule):
+    if rule.get("in_automaton") and SEQUENCE_MODE == "automaton":
+        return
+    FI, FV = sel_lits(shift_bits(rule["first"]))
+    TI, TV = sel_lits(shift_bits(rule["then"]))
+    on = [w.upper() for w in rule.get("on", ())]
+    days = [d for d in range(NUM_DAYS - 1) if not on or (weekdays[d], weekdays[d + 1]) == tuple(on)]
+    rows = rule_staff(rule)
+    sel = _cells(rows, days)
+    nxt = _cells(rows, [d + 1 for d in days])
+    # first on d + then on d+1 <= 1
+    idx = np.stack([FI[sel].ravel(), TI[nxt].ravel()], axis=1)
+    val = np.stack([FV[sel].ravel(), TV[nxt].ravel()], axis=1)
+    bulk.add_linear(idx, val, 1, hi=1)
+
+def compile_daily_count(rule):
+    LI, LV = sel_lits(shift_bits(rule["shifts"]))
+    sel = _cells(rule_staff(rule), rule_days(rule))
+    bulk.add_linear(LI[sel].T, LV[sel].T, 1, rule.get("min"), rule.get("max"))
+
+def compile_quota(rule):
+    LI, LV = sel_lits(shift_bits(rule["shifts"]))
+    # per-row bounds (sheet values may differ per staff); a row with neither bound is left out
+    rows = [(s, rule_value(rule, "min", s), rule_value(rule, "max", s)) for s in rule_staff(rule)]
+    rows = [r for r in rows if r[1] is not None or r[2] is not None]
+    if not rows:
+        return
+    staff_rows, lo, hi = zip(*rows)
+    sel = _cells(staff_rows, rule_days(rule))
+    bulk.add_linear(LI[sel], LV[sel], 1, np.array(lo, dtype=object), np.array(hi, dtype=object))
+
+RULE_COMPILERS = {
+    "coverage": compile_coverage, "rank_mix": compile_rank_mix, "night_quotas": compile_night_quotas,
+    "window": compile_window, "weekly_cap": compile_weekly_cap, "sequence": compile_sequence,
+    "daily_count": compile_daily_count, "quota": compile_quota,
+}
 
-        # Weekly Z cap (non-overlapping 7-day chunks)
-        for wk in range(0, NUM_DAYS, 7):
-            model.Add(sum(X[s, d, "Z"] for d in range(wk, min(wk + 7, NUM_DAYS))) <= 5)
+def compile_rules(rules):
+    for rule in rules:
+        registry.family(rule["name"])
+        RULE_COMPILERS[rule["type"]](rule)
 
+compile_rules(RULES["rules"])
 
-# --- Enforce per-day min/max by cadre on A and P ---
-for d in range(NUM_DAYS):
-    am_cov, pm_cov, _nt_cov = cov_targets_per_day[d]
 
-    # Clamp bounds to daily coverage so we don't create impossible constraints
-    minsenA = min(int(minsenA_per_day[d] or 0), am_cov)
-    maxsenA = min(int(maxsenA_per_day[d] or 99), am_cov)
-    minsenP = min(int(minsenP_per_day[d] or 0), pm_cov)
-    maxsenP = min(int(maxsenP_per_day[d] or 99), pm_cov)
+registry.family("one shift/day")
+# one shift/day (a single-shift cell is already a constant; an empty domain stays infeasible)
+bulk.add_exactly_one(XI[dom_size != 1])
 
-    # Seniors on A/P
-    model.Add(sum(X[s, d, "A"] for s in senior_idx) >= minsenA)
-    model.Add(sum(X[s, d, "A"] for s in senior_idx) <= maxsenA)
-    model.Add(sum(X[s, d, "P"] for s in senior_idx) >= minsenP)
-    model.Add(sum(X[s, d, "P"] for s in senior_idx) <= maxsenP)
 
+#### CONSTRAINTS ####
 
+# (3×PM, 4×PM and PM→AM→Night detectors are built once, with the penalty variables below)
+
+# The SUN-Off / WE-Off quotas, the A–N–O sequence and N spacing are rules in the spec
+# ("SUN-Off quota", "off after night", "night spacing", ...); a fixed A↗ and the day -1 → day 0
+# adjacency are cell domains (cell_domains()).
+
+
+registry.family("sequence automaton")
+# === 2.x Sequence automaton (--sequence-mode automaton) ===
+# One AddAutomaton per staff over a per-day label = shift class (+ Sunday-after-Saturday flag)
+# replaces the reified A–N–O rules, the Sat→Sun PM ban, the day -1 → day 0 adjacency and the
+# R/S/T caps on PA / PAN / PPP. The state is (last-duty state, PA count, PAN count, PPP count);
+# a count is only tracked when its cap binds, and the prior-month tail sets the start state.
+SEQ_OFF, SEQ_A, SEQ_P, SEQ_N, SEQ_W, SEQ_AX = range(6)   # label classes (AX = fixed A↗)
+SEQ_SUN = 6                                               # label offset on a Sunday after a Saturday
+FREE, AFTER_A, AFTER_PA, AFTER_N, AFTER_P, AFTER_PP = range(6)   # last-duty states
+
+def _seq_class(s, d, k):
+    cls = SHIFT_CLASS[k]
+    if cls & CLS_OFF:
+        return SEQ_OFF
+    if cls & CLS_NIGHT:
+        return SEQ_N
+    if k == SH_A:
+        arrow = (s, d) in fixed_raw and fixed_clean[(s, d)].upper() == "A" and fixed_raw[(s, d)].endswith("↗")
+        return SEQ_AX if arrow else SEQ_A
+    if k == SH_P:
+        return SEQ_P
+    return SEQ_W
+
+def _seq_step(q, k):
+    """Next last-duty state and (PA, PAN, PPP) increments, or None if the move is forbidden."""
+    if q == AFTER_N:
+        return (FREE, 0, 0, 0) if k == SEQ_OFF else None
+    if k in (SEQ_OFF, SEQ_W):
+        return FREE, 0, 0, 0
+    if k in (SEQ_A, SEQ_AX):
+        after_p = q in (AFTER_P, AFTER_PP)
+        return (AFTER_PA if after_p else AFTER_A) if k == SEQ_A else FREE, int(after_p), 0, 0
+    if k == SEQ_N:
+        return (AFTER_N, 0, int(q == AFTER_PA), 0) if q in (AFTER_A, AFTER_PA) else None
+    # k == SEQ_P
+    return (AFTER_PP, 0, 0, 1) if q == AFTER_PP else (AFTER_PP if q == AFTER_P else AFTER_P, 0, 0, 0)
+
+def _seq_start(s):
+    core  = str(prev_last7[s][6] or "").strip()
+    last  = core.rstrip("*")
+    prev2 = str(prev_last7[s][5] or "").strip().rstrip("*")
+    if core in NIGHT_SH:
+        return AFTER_N
+    if core == "A" and not prev_last7_arrow[s][6]:
+        return AFTER_PA if prev2 == "P" else AFTER_A
+    if last == "P":
+        return AFTER_PP if prev2 == "P" else AFTER_P
+    return FREE
+
+def add_sequence_automaton(s):
+    caps = [c if c < NUM_DAYS else None for c in roster.pattern_caps[s].tolist()]   # PA, PAN, PPP
+    dims = [1 if c is None else c + 1 for c in caps]
+    encode = lambda q, n: ((q * dims[0] + n[0]) * dims[1] + n[1]) * dims[2] + n[2]
+
+    labels = []
+    for d in range(NUM_DAYS):
+        sun = SEQ_SUN if d >= 1 and weekdays[d] == "SUN" and weekdays[d - 1] == "SAT" else 0
+        allowed = np.flatnonzero(dom_mask[s, d]).tolist()
+        if len(allowed) == 1:
+            labels.append(_seq_class(s, d, allowed[0]) + sun)
+            continue
+        lab = model.NewIntVarFromDomain(
+            cp_model.Domain.FromValues(sorted({_seq_class(s, d, k) + sun for k in allowed})), f"seq_{s}_{d}")
+        model.Add(lab == sum((_seq_class(s, d, k) + sun) * X[s, d, k] for k in allowed))
+        labels.append(lab)
+
+    triples = []
+    for q in range(6):
+        for n in np.ndindex(*dims):
+            for k in range(6):
+                step = _seq_step(q, k)
+                if step is None:
+                    continue
+                q2, inc = step[0], step[1:]
+                n2 = tuple(n[i] + (inc[i] if caps[i] is not None else 0) for i in range(3))
+                if any(n2[i] >= dims[i] for i in range(3)):
+                    continue   # would exceed the cap
+                triples.append((encode(q, n), k, encode(q2, n2)))
+                # Sunday after Saturday: same moves, but no P right after a P
+                if not (k == SEQ_P and q in (AFTER_P, AFTER_PP)):
+                    triples.append((encode(q, n), k + SEQ_SUN, encode(q2, n2)))
+    final = list(range(6 * dims[0] * dims[1] * dims[2]))
+    model.AddAutomaton(labels, encode(_seq_start(s), (0, 0, 0)), final, triples)
+
+if SEQUENCE_MODE == "automaton":
+    for s in range(NUM_STAFF):
+        add_sequence_automaton(s)
+
+# COS (OFF unless requested) and CON1 & CON2 (OFF on WE, A/Z/OFF on WD) rows are
+# handled by cell_domains(); their weekly Z cap is the "CON weekly Z" rule.
+
+
+registry.family("specialist on A")
 # --- Enforce: each day ≥1 shift‐specialist on AM not followed by night next day ---
 # Define your shift‐specialists set if not already defined:
 shift_specialists = {
@@ -604,99 +1813,22 @@ shift_specialists = {
     if r.upper().startswith(("CON1","CON2","CON3","AC"))
 }
 
-# Build helper BoolVars for “AM today and no night tomorrow”
-spec_ok = {}
+# Helper literals for “AM today and no night tomorrow”
 for s in shift_specialists:
     for d in range(NUM_DAYS - 1):
-        v = model.NewBoolVar(f"spec_ok_{s}_{d}")
-        # v == 1 ↔ X[s,d,"A"] is true AND X[s,d+1,night] are all false
-        model.AddBoolAnd(
-            [X[s, d, "A"]] +
-            [X[s, d+1, nt].Not() for nt in NIGHT_SH]
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, d, "A"].Not()] +
-            [X[s, d+1, nt]    for nt in NIGHT_SH] +
-            [v]
-        )
-        spec_ok[(s, d)] = v
+        v = all_of([X[s, d, SH_A], lit_not(is_night[s][d+1])], f"spec_ok_{s}_{d}")
+        if not (isinstance(v, int) and v == 0):
+            detectors.add("spec_ok", s, d, v)
 
 # Finally, require at least one such specialist each day
 for d in range(NUM_DAYS - 1):
-    model.Add(
-        sum(v for (s, dd), v in spec_ok.items() if dd == d)
-        >= 1
-    )
-
-
-# cap consecutive working days to ≤6
-for s in range(NUM_STAFF):
-    for start in range(NUM_DAYS - 6):
-        # sum of non-OFF in any 7-day window ≤ 6
-        model.Add(sum(
-            X[s, d, t]
-            for d in range(start, start + 7)
-            for t in SHIFTS if t not in OFF
-        ) <= 6)
-
-# === Extend "≤6 work days in any 7-day window" across the month boundary ===
-# We treat any non-OFF code in prev_last7 as a "work day".
-# prev_last7[s][0] ... prev_last7[s][6]  → 7th to 1st day BEFORE day 1 of this month
-# Index 6 is the last day of last month.
-
-def _is_work(code: str) -> int:
-    return 0 if (str(code or "").strip() in OFF) else 1
-
-for s in range(NUM_STAFF):
-    # For k = 1..6, consider the 7-day window that ends before we have
-    # k previous days and (7-k) current days starting at day 0.
-    # Example: k=2 window = [prev_day(-2), prev_day(-1), day0, day1, day2, day3, day4]
-    for k in range(1, 7):
-        # Count how many of the last k previous days were "work"
-        # These are indices [7-k, 6] in prev_last7
-        prev_work_cnt = sum(_is_work(prev_last7[s][i]) for i in range(7 - k, 7))
-
-        # Number of current days in this cross-boundary window
-        cur_len = 7 - k
-        if cur_len <= 0:
-            continue  # no current days to constrain
-
-        # Upper bound for "work" among the first cur_len days of this month
-        # to keep total ≤ 6 in the 7-day window
-        allow_cur_work = 6 - prev_work_cnt
-        if allow_cur_work < 0:
-            # Already violated in prior month; the best we can do now is
-            # force the current part to 0 work for this window.
-            allow_cur_work = 0
-
-        model.Add(
-            sum(
-                X[s, d, t]
-                for d in range(cur_len)               # days 0 .. (cur_len-1)
-                for t in SHIFTS if t not in OFF
-            ) <= allow_cur_work
-        )
-
-        
+    model.Add(sum(detectors.on_day("spec_ok", d)) >= 1)
 
 
-# 1) Build the HT1+HT2 index set
-ht_group = {
-    s for s, r in enumerate(ranks)
-    if r.upper().startswith(("HT1", "HT2"))
-}
-
-# 2) For each day classified as "WE", require at least one HT on AM
-for d in range(NUM_DAYS):
-    if day_type[d] == "WE":
-        model.Add(
-            sum(X[s, d, "A"] for s in ht_group)
-            >= 1
-        )
-
 
+registry.family("hour balance")
 # 2.x Hours & balance constraints
-threshold = int(ws_roster["O2"].value or 0)
+threshold = roster.settings["threshold"]
 
 # define shift durations
 shift_hours = {t: 9 for t in SHIFTS}
@@ -707,42 +1839,28 @@ final_hr      = {}
 non_cos       = [s for s,name in enumerate(staff)
                  if not ranks[s].upper().startswith("COS")]
 
-# --- NEW: read per-staff target ranges (min/max) from CF/CG ---
-# CF = 84 (min), CG = 85 (max)
-per_staff_bounds = {}  # s -> (min_or_None, max_or_None)
-
-for s, name in enumerate(staff):
-    row = ROW_START + s
-    raw_min = ws_roster.cell(row=row, column=16).value  # CF
-    raw_max = ws_roster.cell(row=row, column=17).value  # CG
-
-    # Clean cast to int if present, else None
-    lb = None if raw_min in (None, "") else int(raw_min)
-    ub = None if raw_max in (None, "") else int(raw_max)
-
-    # If someone accidentally types lb>ub, swap to be safe
-    if (lb is not None) and (ub is not None) and (lb > ub):
-        lb, ub = ub, lb
+# --- NEW: per-staff target ranges (min/max) from P/Q ---
+per_staff_bounds = dict(enumerate(roster.hr_bounds))  # s -> (min_or_None, max_or_None)
 
-    per_staff_bounds[s] = (lb, ub)
+# total hours assigned per [s, d, shift] (exclude prefilled requests)
+HRS = np.tile(np.array([shift_hours[t] for t in SHIFTS], dtype=np.int64), (NUM_STAFF, NUM_DAYS, 1))
+for (s, d) in fixed_clean:
+    HRS[s, d] = 0   # skip fixed requests
 
 for s,name in enumerate(staff):
-    # total hours assigned (exclude prefilled requests)
-    h = model.NewIntVar(0, NUM_DAYS*9, f"hrs_{s}")
-    hour_assigned[s] = h
-    model.Add(
-        h == sum(
-            X[s,d,t] * shift_hours[t]
-            for d in range(NUM_DAYS)
-            for t in SHIFTS
-            if (s,d) not in fixed_clean  # skip fixed requests
-        )
-    )
+    if s in FIXED_ROWS:   # presolved row: constant hours
+        hours = int((XV[s] * HRS[s]).sum())
+        hour_assigned[s] = hours
+        final_hr[s] = int(quotas[name]["init_hr"]) + hours
+    else:
+        h = model.NewIntVar(0, NUM_DAYS*9, f"hrs_{s}")
+        hour_assigned[s] = h
 
-    # final hour balance
-    fh = model.NewIntVar(-100000, 100000, f"fh_{s}")
-    final_hr[s] = fh
-    model.Add(fh == int(quotas[name]["init_hr"]) + h)
+        # final hour balance
+        fh = model.NewIntVar(-100000, 100000, f"fh_{s}")
+        final_hr[s] = fh
+        model.Add(fh == int(quotas[name]["init_hr"]) + h)
+    fh = final_hr[s]
 
     # --- NEW: enforce personal min/max if provided ---
     lb, ub = per_staff_bounds[s]
@@ -751,628 +1869,811 @@ for s,name in enumerate(staff):
     if ub is not None:
         model.Add(fh <= ub)
 
-# --- Pairwise hard cap (only among staff WITHOUT a personal range) ---
+# h == hours, i.e. h - sum(hours * X) == 0, for every row that is not presolved out
+var_rows = [s for s in range(NUM_STAFF) if s not in FIXED_ROWS]
+h_col = np.array([[hour_assigned[s].Index()] for s in var_rows], dtype=np.int64).reshape(-1, 1)
+flat = (len(var_rows), NUM_DAYS * len(SHIFTS))
+bulk.add_linear(np.concatenate([h_col, XI[var_rows].reshape(flat)], axis=1),
+                np.concatenate([np.zeros_like(h_col), XV[var_rows].reshape(flat)], axis=1),
+                np.concatenate([np.ones_like(h_col), -HRS[var_rows].reshape(flat)], axis=1), 0, 0)
+
+# --- Hour-balance spread cap (only among staff WITHOUT a personal range) ---
 eligible_for_pairwise = [
     s for s in non_cos
     if per_staff_bounds[s][0] is None and per_staff_bounds[s][1] is None
 ]
 
-for i in range(len(eligible_for_pairwise)):
-    for j in range(i+1, len(eligible_for_pairwise)):
-        si, sj = eligible_for_pairwise[i], eligible_for_pairwise[j]
-        # |final_hr[si] - final_hr[sj]| <= threshold
-        diff = model.NewIntVar(-threshold, threshold, f"diff_{si}_{sj}")
-        model.Add(diff == final_hr[si] - final_hr[sj])
-        absdiff = model.NewIntVar(0, threshold, f"abs_{si}_{sj}")
-        model.AddAbsEquality(absdiff, diff)
+# |final_hr[si] - final_hr[sj]| <= threshold for every pair  <=>  max - min <= threshold,
+# so keep one shared envelope [hr_lo, hr_hi] around them (linear in staff, not pairwise)
+if len(eligible_for_pairwise) >= 2:
+    hr_lo = model.NewIntVar(-100000, 100000, "hr_lo")
+    hr_hi = model.NewIntVar(-100000, 100000, "hr_hi")
+    for s in eligible_for_pairwise:
+        model.Add(final_hr[s] >= hr_lo)
+        model.Add(final_hr[s] <= hr_hi)
+    model.Add(hr_hi - hr_lo <= threshold)
 
 
 
 # === P/A‐ratio constraints (per staff) ===
-for s, name in enumerate(staff):
-    # count PM and AM
-    total_pm = sum(X[(s, d, t)] for d in range(NUM_DAYS) for t in PM_SH)
-    total_am = sum(X[(s, d, t)] for d in range(NUM_DAYS) for t in AM_SH)
+# count PM and AM: one row per staff of PM terms followed by AM terms
+pm_idx, pm_val = x_rows(codes_of(CLS_PM), "staff")
+am_idx, am_val = x_rows(codes_of(CLS_AM), "staff")
+pa_idx, pa_val = np.concatenate([pm_idx, am_idx], axis=1), np.concatenate([pm_val, am_val], axis=1)
 
-    # retrieve from quotas
-    max_pa = int(quotas[name]["max_pa"] * 100)
-    min_pa = int(quotas[name]["min_pa"] * 100)
+# retrieve from quotas
+max_pa = np.array([int(quotas[name]["max_pa"] * 100) for name in staff], dtype=np.int64)
+min_pa = np.array([int(quotas[name]["min_pa"] * 100) for name in staff], dtype=np.int64)
 
-    # enforce: min_pa ≤ total_pm/total_am ≤ max_pa
-    model.Add(total_pm * 100 <= total_am * max_pa)
-    model.Add(total_pm * 100 >= total_am * min_pa)
+# enforce: min_pa ≤ total_pm/total_am ≤ max_pa, i.e. total_pm*100 - total_am*max_pa <= 0 and
+# total_pm*100 - total_am*min_pa >= 0
+pm_coef = np.full(pm_idx.shape, 100, dtype=np.int64)
+bulk.add_linear(pa_idx, pa_val, np.concatenate([pm_coef, -max_pa[:, None] * np.ones_like(am_idx)], axis=1), hi=0)
+bulk.add_linear(pa_idx, pa_val, np.concatenate([pm_coef, -min_pa[:, None] * np.ones_like(am_idx)], axis=1), lo=0)
 
 # === Global P/A ratio constraint ===
-total_pm_all = sum(X[(s, d, t)] for s in range(NUM_STAFF) for d in range(NUM_DAYS) for t in PM_SH)
-total_am_all = sum(X[(s, d, t)] for s in range(NUM_STAFF) for d in range(NUM_DAYS) for t in AM_SH)
-
 scaling_factor = 100
 globalmax_pa = int(globalmax_pa * scaling_factor)  # Make sure it's defined or read from Excel
 
 # Enforce: total_pm_all / total_am_all ≤ globalmax_pa
-model.Add(total_pm_all * scaling_factor <= total_am_all * globalmax_pa)
-
-
-
-# === 2.x Build penalty variables for soft objectives ===
-# --- PM→AM→Night detectors (PAN) ---
-# --- Unified PAN detector: count N-days that have PA immediately before (handles month boundary) ---
-pm_am_night = []
+bulk.add_linear(pa_idx.reshape(1, -1), pa_val.reshape(1, -1),
+                np.concatenate([np.full(pm_idx.shape, scaling_factor), np.full(am_idx.shape, -globalmax_pa)],
+                               axis=1).reshape(1, -1), hi=0)
 
-def _norm(code: object) -> str:
-    # normalize prior-month codes like "P*" -> "P", "A*" -> "A"
-    return str(code or "").strip().rstrip("*")
 
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        # isNight(d)
-        isN = model.NewBoolVar(f"isN_{s}_{d}")
-        model.Add(sum(X[s, d, t] for t in NIGHT_SH) == 1).OnlyEnforceIf(isN)
-        model.Add(sum(X[s, d, t] for t in NIGHT_SH) == 0).OnlyEnforceIf(isN.Not())
-
-        # prev is AM: day d-1 if in-month, else last day of prev month
-        prevAM = model.NewBoolVar(f"prevAM_{s}_{d}")
-        if d >= 1:
-            model.Add(sum(X[s, d-1, t] for t in AM_SH) == 1).OnlyEnforceIf(prevAM)
-            model.Add(sum(X[s, d-1, t] for t in AM_SH) == 0).OnlyEnforceIf(prevAM.Not())
-        else:
-            # d == 0 → use prev_last7[s][6]
-            model.Add(prevAM == (1 if _norm(prev_last7[s][6]) == "A" else 0))
-
-        # prevprev is PM: day d-2 if in-month, else pull from prev month as needed
-        prevPM = model.NewBoolVar(f"prevPM_{s}_{d}")
-        if d >= 2:
-            model.Add(sum(X[s, d-2, t] for t in PM_SH) == 1).OnlyEnforceIf(prevPM)
-            model.Add(sum(X[s, d-2, t] for t in PM_SH) == 0).OnlyEnforceIf(prevPM.Not())
-        elif d == 1:
-            # look at prev_last7[s][6]
-            model.Add(prevPM == (1 if _norm(prev_last7[s][6]) == "P" else 0))
-        else:  # d == 0 → look at prev_last7[s][5]
-            model.Add(prevPM == (1 if _norm(prev_last7[s][5]) == "P" else 0))
-
-        # v == 1  <=>  (prevprev=PM) ∧ (prev=AM) ∧ (today=Night)
-        v = model.NewBoolVar(f"pan_hit_{s}_{d}")
-        model.AddBoolAnd([prevPM, prevAM, isN]).OnlyEnforceIf(v)
-        model.AddBoolOr([prevPM.Not(), prevAM.Not(), isN.Not(), v])
-
-        pm_am_night.append(v)
-
-pm_am = []
-# PM→AM transitions (PA)
-for s in range(NUM_STAFF):
-    for d in range(1, NUM_DAYS):
-        v = model.NewBoolVar(f"pm_am_{s}_{d}")
-        model.AddBoolAnd(
-            [X[s, d-1, t] for t in PM_SH] +
-            [X[s, d,   t] for t in AM_SH]
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, d-1, t].Not() for t in PM_SH] +
-            [X[s, d,   t].Not() for t in AM_SH] +
-            [v]
-        )
-        pm_am.append(v)
-
-three_pm = []
-# 3-consecutive PM runs
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS-2):
-        v = model.NewBoolVar(f"three_pm_{s}_{d}")
-        model.Add(
-            sum(X[s, d+k, t] for k in range(3) for t in PM_SH) == 3
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, d+k, t].Not() for k in range(3) for t in PM_SH] + [v]
-        )
-        three_pm.append(v)
-
-# --- track 4-consecutive PM runs (PPPP) ---
-four_pm = []
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS - 3):
-        v = model.NewBoolVar(f"four_pm_{s}_{d}")
-        # v == 1  <=>  exactly 4 PMs on d..d+3
-        model.Add(
-            sum(X[s, d+k, t] for k in range(4) for t in PM_SH) == 4
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, d+k, t].Not() for k in range(4) for t in PM_SH] + [v]
-        )
-        four_pm.append(v)
-
-# === Boundary-aware caps for PA / PAN / PPP (count if the last day is in THIS month) ===
-# Assumes:
-#   - pm_am:      intra-month PA booleans with names containing f"_{s}_"
-#   - pm_am_night:intra-month PAN booleans with names containing f"_{s}_"
-#   - three_pm:   intra-month PPP booleans with names containing f"_{s}_"
-#   - prev_last7[s][i]: clean codes for prior month (i=6 is last day, i=5 is -2)
-#   - AM_SH, PM_SH, NIGHT_SH sets; X[s,d,t] decision vars
 
-def _norm(code: object) -> str:
-    # normalize prior-month codes such as "A↗", "P*" → "A","P"
-    return str(code or "").strip().rstrip("↗").rstrip("*")
-
-def _in_prev(code_set, s, idx):
-    return _norm(prev_last7[s][idx]) in code_set
+# === Single toggle from D3: apply ALL penalties if "Y" ===
+do_penalty = roster.settings["do_penalty"]
 
-def _vars_for_staff(var_list, s):
-    tag = f"_{s}_"
-    return [v for v in var_list if tag in v.Name()]
+# === Penalty Weights / Toggles (rule spec "penalties") ===
+# Use integer for soft penalty, "X" (string) to prohibit pattern
+W_PAN = RULES["penalties"]["PAN"]    # PM→AM→Night chains
+W_PA  = RULES["penalties"]["PA"]     # PM→AM transitions
+W_3PM = RULES["penalties"]["PPP"]    # 3 consecutive PMs
+W_4PM = RULES["penalties"]["PPPP"]   # 4 consecutive PMs
 
-# Boundary detector lists (one BoolVar per staff for each boundary case)
-PA_b0   = []  # PA with last day = day 0 (prev[-1]=P, day0=A)
-PAN_b0  = []  # PAN with last day = day 0 (prev[-2]=P, prev[-1]=A, day0=Night)
-PAN_b1  = []  # PAN with last day = day 1 (prev[-1]=P, day0=A, day1=Night)
-PPP_b0  = []  # PPP with last day = day 0 (prev[-2]=P, prev[-1]=P, day0=P)
-PPP_b1  = []  # PPP with last day = day 1 (prev[-1]=P, day0=P, day1=P)
+registry.family("pattern detectors")
+# === 2.x Build penalty variables for soft objectives ===
+# PA (P→A), PAN (P→A→N), PPP and PPPP, each counted on the last day of the pattern.
+# Days before day 0 read prev_last7 through shift_lit(), so the cross-month cases fold to
+# constants (or to the in-month literal) and need no separate boundary detectors.
+#
+# A detector is only built where something reads it: the penalties (D3 = Y), a binding R/S/T
+# cap (reified mode; the automaton counts its own) or a row-68 daily PA cap. The PA / PAN / PPP
+# statistics in Output1 are counted from the solved roster, so a plain feasibility run
+# ("N", no caps) builds none.
+PATTERN_CAP_COL = {"PA": 0, "PAN": 1, "PPP": 2}   # column of roster.pattern_caps
+
+def detector_needed(family, s, d):
+    if do_penalty:
+        return True
+    col = PATTERN_CAP_COL.get(family)
+    if SEQUENCE_MODE == "reified" and col is not None and roster.pattern_caps[s, col] < NUM_DAYS:
+        return True
+    return family == "PA" and roster.daily_pa_cap[d] < NUM_STAFF
+
+def _detect(family, s, d, lits, name):
+    if not detector_needed(family, s, d):
+        return
+    v = all_of(lits, f"{name}_{s}_{d}")
+    if not (isinstance(v, int) and v == 0):
+        detectors.add(family, s, d, v)
 
 for s in range(NUM_STAFF):
-    # ---- PA boundary (last day d=0) ----
-    if _in_prev(PM_SH, s, 6):
-        v = model.NewBoolVar(f"PA_boundary_{s}_d0")
-        model.AddBoolAnd([X[s, 0, t] for t in AM_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in AM_SH] + [v])
-        PA_b0.append(v)
-    else:
-        # make a 0-constant Bool for uniform summation
-        v = model.NewBoolVar(f"PA_boundary_{s}_d0_zero")
-        model.Add(v == 0)
-        PA_b0.append(v)
-
-    # ---- PAN boundary (last day d=0) ----
-    if _in_prev(PM_SH, s, 5) and _in_prev(AM_SH, s, 6):
-        v = model.NewBoolVar(f"PAN_boundary_{s}_d0")
-        model.AddBoolAnd([X[s, 0, t] for t in NIGHT_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in NIGHT_SH] + [v])
-        PAN_b0.append(v)
-    else:
-        v = model.NewBoolVar(f"PAN_boundary_{s}_d0_zero")
-        model.Add(v == 0)
-        PAN_b0.append(v)
-
-    # ---- PAN boundary (last day d=1) ----
-    if _in_prev(PM_SH, s, 6) and NUM_DAYS >= 2:
-        v = model.NewBoolVar(f"PAN_boundary_{s}_d1")
-        # day0=A and day1=Night
-        model.AddBoolAnd(
-            [X[s, 0, t] for t in AM_SH] +
-            [X[s, 1, t] for t in NIGHT_SH]
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in AM_SH] +
-            [X[s, 1, t].Not() for t in NIGHT_SH] + [v]
-        )
-        PAN_b1.append(v)
-    else:
-        v = model.NewBoolVar(f"PAN_boundary_{s}_d1_zero")
-        model.Add(v == 0)
-        PAN_b1.append(v)
-
-    # ---- PPP boundary (last day d=0) ----
-    if _in_prev(PM_SH, s, 5) and _in_prev(PM_SH, s, 6):
-        v = model.NewBoolVar(f"PPP_boundary_{s}_d0")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) == 1).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in PM_SH] + [v])
-        PPP_b0.append(v)
-    else:
-        v = model.NewBoolVar(f"PPP_boundary_{s}_d0_zero")
-        model.Add(v == 0)
-        PPP_b0.append(v)
-
-    # ---- PPP boundary (last day d=1) ----
-    if _in_prev(PM_SH, s, 6) and NUM_DAYS >= 2:
-        v = model.NewBoolVar(f"PPP_boundary_{s}_d1")
-        model.Add(
-            sum(X[s, 0, t] for t in PM_SH) +
-            sum(X[s, 1, t] for t in PM_SH) == 2
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in PM_SH] +
-            [X[s, 1, t].Not() for t in PM_SH] + [v]
-        )
-        PPP_b1.append(v)
-    else:
-        v = model.NewBoolVar(f"PPP_boundary_{s}_d1_zero")
-        model.Add(v == 0)
-        PPP_b1.append(v)
-
-# Build per-doctor IntVars = intra-month detectors + boundary detectors
+    am = [shift_lit(s, d, CLS_AM, "am") for d in range(-3, NUM_DAYS)]   # am[d + 3]
+    pm = [shift_lit(s, d, CLS_PM, "pm") for d in range(-3, NUM_DAYS)]
+    for d in range(NUM_DAYS):
+        i = d + 3
+        _detect("PAN",  s, d, [pm[i-2], am[i-1], is_night[s][d]], "pan_hit")
+        _detect("PA",   s, d, [pm[i-1], am[i]], "pm_am")
+        _detect("PPP",  s, d, pm[i-2:i+1], "three_pm")
+        _detect("PPPP", s, d, pm[i-3:i+1], "four_pm")
+
+registry.family("pattern caps")
+# === Caps for PA / PAN / PPP (count if the last day is in THIS month) ===
+# Per-doctor counters from the detectors, only where an R/S/T cap binds
+# (blank -> 99; a cap ≥ NUM_DAYS can never bind). The automaton counts these itself.
 PA_cnt_var  = {}
 PAN_cnt_var = {}
 PPP_cnt_var = {}
 
-def _as_int_or(v, default=99):
-    try: return int(v)
-    except (TypeError, ValueError): return default
-
-for s in range(NUM_STAFF):
-    pa_vars_in   = _vars_for_staff(pm_am,       s)  # includes any in-month PA vars
-    pan_vars_in  = _vars_for_staff(pm_am_night, s)  # includes in-month PAN vars
-    ppp_vars_in  = _vars_for_staff(three_pm,    s)  # includes in-month PPP vars
-
-    # Add matching boundary var for this s (same index in the lists)
-    vPA  = model.NewIntVar(0, len(pa_vars_in)+1,             f"PA_sum_{s}")
-    vPAN = model.NewIntVar(0, len(pan_vars_in)+2,            f"PAN_sum_{s}")
-    vPPP = model.NewIntVar(0, len(ppp_vars_in)+2,            f"PPP_sum_{s}")
-
-    # Each boundary list is in staff order; pick the s-th entry
-    model.Add(vPA  == sum(pa_vars_in)  + PA_b0[s])
-    model.Add(vPAN == sum(pan_vars_in) + PAN_b0[s] + PAN_b1[s])
-    model.Add(vPPP == sum(ppp_vars_in) + PPP_b0[s] + PPP_b1[s])
-
-    PA_cnt_var[s]  = vPA
-    PAN_cnt_var[s] = vPAN
-    PPP_cnt_var[s] = vPPP
-
-    # Caps from R,S,T (blank -> 99)
-    row = ROW_START + s
-    cap_PA  = _as_int_or(ws_roster.cell(row=row, column=18).value, 99)  # R
-    cap_PAN = _as_int_or(ws_roster.cell(row=row, column=19).value, 99)  # S
-    cap_PPP = _as_int_or(ws_roster.cell(row=row, column=20).value, 99)  # T
-
-    model.Add(vPA  <= cap_PA)
-    model.Add(vPAN <= cap_PAN)
-    model.Add(vPPP <= cap_PPP)
-
-
-# === Read single toggle from D3: apply ALL penalties if "Y" ===
-do_penalty = str(ws_roster.cell(row=3, column=4).value or "").strip().upper() == "Y"
-
-# === Cross‑month penalty detectors (extend penalties across the boundary) ===
-# Uses prev_last7[s][i] (clean code) where i=6 is last day of last month.
-# Reuses AM_SH, PM_SH, NIGHT_SH, and the penalty arrays you already built.
-
-def _in_set(code, sset):
-    return str(code or "").strip() in sset
+if SEQUENCE_MODE == "reified":
+    for s in range(NUM_STAFF):
+        for family, cnt_var in (("PA", PA_cnt_var), ("PAN", PAN_cnt_var), ("PPP", PPP_cnt_var)):
+            cap = int(roster.pattern_caps[s, PATTERN_CAP_COL[family]])
+            if cap >= NUM_DAYS:
+                continue
+            hits = detectors.for_staff(family, s)
+            v = model.NewIntVar(0, len(hits), f"{family}_sum_{s}")
+            model.Add(v == sum(hits))
+            model.Add(v <= cap)
+            cnt_var[s] = v
 
-for s in range(NUM_STAFF):
-    # ---------- PA (PM → AM) across boundary: [-1, 0] ----------
-    if _in_set(prev_last7[s][6], PM_SH):
-        v = model.NewBoolVar(f"pm_am_boundary_{s}_0")
-        # v == 1  <=>  day0 is AM  (prev day is fixed PM, so it's a constant condition)
-        model.AddBoolAnd([X[s, 0, t] for t in AM_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in AM_SH] + [v])
-        pm_am.append(v)
-
-    # ---------- PAN (PM → AM → Night) across boundary ----------
-    # Case A: [-2, -1, 0]  (prev[-2]=PM, prev[-1]=AM, day0=Night)
-    if _in_set(prev_last7[s][5], PM_SH) and _in_set(prev_last7[s][6], AM_SH):
-        v = model.NewBoolVar(f"pan_boundary_A_{s}_0")
-        model.AddBoolAnd([X[s, 0, t] for t in NIGHT_SH]).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in NIGHT_SH] + [v])
-        pm_am_night.append(v)
-
-    # Case B: [-1, 0, 1]  (prev[-1]=PM, day0=AM, day1=Night)
-    if _in_set(prev_last7[s][6], PM_SH) and NUM_DAYS >= 2:
-        v = model.NewBoolVar(f"pan_boundary_B_{s}_0_1")
-        model.AddBoolAnd(
-            [X[s, 0, t] for t in AM_SH] +
-            [X[s, 1, t] for t in NIGHT_SH]
-        ).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in AM_SH] +
-            [X[s, 1, t].Not() for t in NIGHT_SH] + [v]
-        )
-        pm_am_night.append(v)
-
-    # ---------- 3×PM across boundary ----------
-    # Patterns: [-2,-1,0], [-1,0,1]
-    # a) [-2,-1,0] = prev[-2]=PM, prev[-1]=PM, day0=PM
-    if _in_set(prev_last7[s][5], PM_SH) and _in_set(prev_last7[s][6], PM_SH):
-        v = model.NewBoolVar(f"three_pm_boundary_{s}_m2_m1_0")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) == 1).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in PM_SH] + [v])
-        three_pm.append(v)
-
-    # b) [-1,0,1] = prev[-1]=PM, day0=PM, day1=PM
-    if _in_set(prev_last7[s][6], PM_SH) and NUM_DAYS >= 2:
-        v = model.NewBoolVar(f"three_pm_boundary_{s}_m1_0_1")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) +
-                  sum(X[s, 1, t] for t in PM_SH) == 2).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in PM_SH] +
-            [X[s, 1, t].Not() for t in PM_SH] + [v]
-        )
-        three_pm.append(v)
-
-    # ---------- 4×PM across boundary (only if you track it) ----------
-    # Patterns: [-3,-2,-1,0], [-2,-1,0,1], [-1,0,1,2]
-    # a) [-3,-2,-1,0]
-    if (_in_set(prev_last7[s][4], PM_SH) and
-        _in_set(prev_last7[s][5], PM_SH) and
-        _in_set(prev_last7[s][6], PM_SH)):
-        v = model.NewBoolVar(f"four_pm_boundary_{s}_m3_m2_m1_0")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) == 1).OnlyEnforceIf(v)
-        model.AddBoolOr([X[s, 0, t].Not() for t in PM_SH] + [v])
-        four_pm.append(v)
-
-    # b) [-2,-1,0,1]
-    if (_in_set(prev_last7[s][5], PM_SH) and
-        _in_set(prev_last7[s][6], PM_SH) and NUM_DAYS >= 2):
-        v = model.NewBoolVar(f"four_pm_boundary_{s}_m2_m1_0_1")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) +
-                  sum(X[s, 1, t] for t in PM_SH) == 2).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in PM_SH] +
-            [X[s, 1, t].Not() for t in PM_SH] + [v]
-        )
-        four_pm.append(v)
-
-    # c) [-1,0,1,2]
-    if _in_set(prev_last7[s][6], PM_SH) and NUM_DAYS >= 3:
-        v = model.NewBoolVar(f"four_pm_boundary_{s}_m1_0_1_2")
-        model.Add(sum(X[s, 0, t] for t in PM_SH) +
-                  sum(X[s, 1, t] for t in PM_SH) +
-                  sum(X[s, 2, t] for t in PM_SH) == 3).OnlyEnforceIf(v)
-        model.AddBoolOr(
-            [X[s, 0, t].Not() for t in PM_SH] +
-            [X[s, 1, t].Not() for t in PM_SH] +
-            [X[s, 2, t].Not() for t in PM_SH] + [v]
-        )
-        four_pm.append(v)
-
-# === Penalty Weights / Toggles ===
-# Use integer for soft penalty, "X" (string) to prohibit pattern
-W_PAN = 10000   # PM→AM→Night chains
-W_PA  = 1000   # PM→AM transitions
-W_3PM = 1000   # 3 consecutive PMs
-W_4PM = "X"    # 4 consecutive PMs (here: prohibit)
 
+registry.family("objective")
 # === Objective / Hard Constraints ===
 if do_penalty:
     obj_terms = []
 
     # PAN (PM→AM→Night)
     if W_PAN == "X":
-        model.Add(sum(pm_am_night) == 0)   # forbid
+        model.Add(sum(detectors.family("PAN")) == 0)   # forbid
     else:
-        obj_terms.append(W_PAN * sum(pm_am_night))
+        obj_terms.append(W_PAN * sum(detectors.family("PAN")))
 
     # PA (PM→AM)
     if W_PA == "X":
-        model.Add(sum(pm_am) == 0)         # forbid
+        model.Add(sum(detectors.family("PA")) == 0)         # forbid
     else:
-        obj_terms.append(W_PA * sum(pm_am))
+        obj_terms.append(W_PA * sum(detectors.family("PA")))
 
     # 3×PM
     if W_3PM == "X":
-        model.Add(sum(three_pm) == 0)      # forbid
+        model.Add(sum(detectors.family("PPP")) == 0)      # forbid
     else:
-        obj_terms.append(W_3PM * sum(three_pm))
+        obj_terms.append(W_3PM * sum(detectors.family("PPP")))
 
     # 4×PM
     if W_4PM == "X":
-        model.Add(sum(four_pm) == 0)       # forbid
+        model.Add(sum(detectors.family("PPPP")) == 0)       # forbid
     else:
-        obj_terms.append(W_4PM * sum(four_pm))
+        obj_terms.append(W_4PM * sum(detectors.family("PPPP")))
 
+    PENALTY = sum(obj_terms) if obj_terms else None   # the soft-penalty objective (--two-phase)
     model.Minimize(sum(obj_terms))
 else:
+    PENALTY = None
     model.Minimize(0)
 
 ##
+registry.family("daily PA caps")
 # === Per-day PA caps (counted on the A day), reading caps from row 59 ===
 # If a cell in row 59 is blank/non-numeric, treat as NUM_STAFF (no effective cap).
 
-def _norm(code: object) -> str:
-    # normalize prior-month codes like "P*", "A↗" → "P","A"
-    return str(code or "").strip().rstrip("*").rstrip("↗")
-
-# Reify helper (var ↔ (assigned shift for (s,d) is in SET))
-def _reify_in_set(var, s, d, SET):
-    model.Add(sum(X[s, d, t] for t in SET) == 1).OnlyEnforceIf(var)
-    model.Add(sum(X[s, d, t] for t in SET) == 0).OnlyEnforceIf(var.Not())
-
-# Build PA-on-day booleans: pa_on_day[(s,d)] == 1 iff (d-1 is PM, d is AM).
-pa_on_day = {}
-
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        v = model.NewBoolVar(f"PA_on_day_{s}_{d}")  # counts on day d (the AM day)
-
-        if d >= 1:
-            isAM   = model.NewBoolVar(f"isAM_{s}_{d}")
-            isPrev = model.NewBoolVar(f"isPM_{s}_{d-1}")
-            _reify_in_set(isAM,   s, d,   AM_SH)
-            _reify_in_set(isPrev, s, d-1, PM_SH)
-
-            # v ↔ (isPrev ∧ isAM)
-            model.AddBoolAnd([isPrev, isAM]).OnlyEnforceIf(v)
-            model.AddBoolOr([isPrev.Not(), isAM.Not(), v])
-        else:
-            # d == 0: look at last day of previous month for PM
-            if _norm(prev_last7[s][6]) == "P":
-                isAM0 = model.NewBoolVar(f"isAM_{s}_0")
-                _reify_in_set(isAM0, s, 0, AM_SH)
-                # v == isAM0
-                model.Add(v == isAM0)
-            else:
-                model.Add(v == 0)
-
-        pa_on_day[(s, d)] = v
-
-# Daily P-A, Read caps from row 68 over the day columns and enforce: sum_s pa_on_day[s,d] ≤ cap_d
+# Daily P-A, caps from row 68 over the day columns (empty/invalid -> NUM_STAFF, no effective cap)
+# and enforce: sum_s PA(s, d) ≤ cap_d, where PA(s, d) = (d-1 is PM, d is AM)
 for d in range(NUM_DAYS):
-    cap_cell = ws_roster.cell(row=68, column=START_COL + d).value
-    try:
-        cap_d = int(cap_cell)
-    except (TypeError, ValueError):
-        cap_d = NUM_STAFF  # treat empty/invalid as no effective cap
-
-    model.Add(sum(pa_on_day[(s, d)] for s in range(NUM_STAFF)) <= cap_d)
+    cap_d = int(roster.daily_pa_cap[d])
+    if cap_d < NUM_STAFF:
+        model.Add(sum(detectors.on_day("PA", d)) <= cap_d)
 
 ##    
-# --- OFF / Sunday-P constraints (with min & max bounds) ---
-for s, name in enumerate(staff):
-    # --- Sundays: OFF count (any OFF-type) ---
-    sun_off = sum(
-        sum(X[s, d, t] for t in OFF)
-        for d, wd in enumerate(weekdays)
-        if wd == "SUN"
-    )
-    model.Add(sun_off >= min_sun_off)
-    model.Add(sun_off <= max_sun_off)
-
-    # --- Weekend/holiday (WE): OFF count (any OFF-type) ---
-    we_off = sum(
-        sum(X[s, d, t] for t in OFF)
-        for d in range(NUM_DAYS)
-        if day_type[d] == "WE"
-    )
-    model.Add(we_off >= min_we_off)
-    model.Add(we_off <= max_we_off)
-
-    # --- Sunday PM duties ---
-    sun_pm = sum(
-        X[s, d, "P"]
-        for d, wd in enumerate(weekdays)
-        if wd == "SUN"
-    )
-
-    sun_p_quota = quotas[name]["SUN P"]  # exact quota if provided
-    if sun_p_quota is not None:
-        # Exact requirement for this doctor
-        model.Add(sun_pm == sun_p_quota)
-        # (Optional) keep the global upper bound too; equality will satisfy it if consistent
-        model.Add(sun_pm <= max_sun_pm)
-    else:
-        # Otherwise, use global min/max bounds
-        model.Add(sun_pm >= min_sun_pm)
-        model.Add(sun_pm <= max_sun_pm)
-
+registry.family("implied")
+# --- Optional (--implied-constraints): redundant aggregate constraints ---
+# Each of these follows from the rules above; stating it directly hands the solver a bound it
+# would otherwise have to prove during search. The WE-Off and Night bounds assume the default
+# Off-quota and A–N–O rules: with a --rules spec that drops those, leave this option off.
+if args.implied_constraints:
+    OFF_BUT_O = ((SHIFT_CLASS & CLS_OFF) != 0) & (np.arange(len(SHIFTS)) != SH_O)   # OFF codes other than "O"
+
+    # Working staff cover at least each day's A/P/N demand, and so over the month
+    total_demand = 0
+    for d in range(NUM_DAYS):
+        demand = sum(cov_targets_per_day[d])
+        model.Add(sum(is_work[s][d] for s in range(NUM_STAFF)) >= demand)
+        total_demand += demand
+    model.Add(sum(cnt_work[s][NUM_DAYS] for s in range(NUM_STAFF)) >= total_demand)
+
+    # Weekend OFF capacity: all staff's WE-Off lower bounds must fit into the OFF places the
+    # WE days leave after their demand
+    we_days = [d for d in range(NUM_DAYS) if day_type[d] == "WE"]
+    we_off_low = {s: max(min_we_off, quotas[name]["WE-Off"] or 0,
+                         min_sun_off, quotas[name]["SUN-Off"] or 0)
+                  for s, name in enumerate(staff)}
+    we_off_all = sum(off_lit(s, d) for s in range(NUM_STAFF) for d in we_days)
+    model.Add(we_off_all >= sum(we_off_low.values()))
+    model.Add(we_off_all <= sum(NUM_STAFF - sum(cov_targets_per_day[d]) for d in we_days))
+
+    work_windows = [rule for rule in rules_of("window") if shift_bits(rule["shifts"]) == CLS_WORK]
+    for s, name in enumerate(staff):
+        if s in FIXED_ROWS:
+            continue
+        # Monthly work days: ≤max per window-length block counted back from the month end (the
+        # leading partial block shares its window with last month's tail), and WE-Off leaves room
+        max_work = NUM_DAYS
+        for rule in work_windows:
+            if s not in rule_staff(rule):
+                continue
+            length, limit = rule_value(rule, "length", s), rule_value(rule, "max", s)
+            if length is None or limit is None:
+                continue
+            r = NUM_DAYS % length
+            prev_cnt = sum(prev_flags(s, CLS_WORK)[7 - min(length - r, 7):]) if r else 0
+            max_work = min(max_work, limit * (NUM_DAYS // length) + min(r, max(limit - prev_cnt, 0)))
+        model.Add(cnt_work[s][NUM_DAYS] <= min(max_work, NUM_DAYS - we_off_low[s]))
+
+        # Hour range: on request-free days every work shift is 9 h and the only OFF is "O"
+        lb, ub = per_staff_bounds[s]
+        free_days = [d for d in range(NUM_DAYS) if (s, d) not in fixed_clean]
+        if (lb is not None or ub is not None) and not (dom_mask[s, free_days] & OFF_BUT_O).any():
+            base = int(quotas[name]["init_hr"])
+            free_work = sum(is_work[s][d] for d in free_days)
+            if lb is not None:
+                model.Add(free_work >= -((base - lb) // 9))   # ceil((lb - base) / 9)
+            if ub is not None:
+                model.Add(free_work <= (ub - base) // 9)
+
+        # Each Night before the last day has its own OFF day after it, and each Night after
+        # day 0 its own A day before it
+        model.Add(sum(off_lit(s, d) for d in range(1, NUM_DAYS)) >=
+                  sum(is_night[s][d] for d in range(NUM_DAYS - 1)))
+        model.Add(sum(X[s, d, SH_A] for d in range(NUM_DAYS - 1)) >=
+                  sum(is_night[s][d] for d in range(1, NUM_DAYS)))
+
+registry.family("symmetry breaking")
+# --- Optional (--symmetry-breaking): interchangeable staff ---
+# Two staff are interchangeable when swapping their rows maps every roster to another valid
+# roster with the same objective: same rank, quota row, hour range, pattern caps, last-month
+# tail and cell domains, and no requests this month. Within each such class the rows are
+# kept in lexicographic order of shift index (SHIFTS order), day by day.
+def interchangeable_classes():
+    classes = {}
+    for s in range(NUM_STAFF):
+        if s in FIXED_ROWS or any((s, d) in fixed_raw for d in range(NUM_DAYS)):
+            continue
+        key = (ranks[s], tuple(np.nan_to_num(roster.quota_arr[s], nan=-1.0).tolist()),
+               roster.hr_bounds[s], tuple(roster.pattern_caps[s].tolist()),
+               tuple(str(v) for v in roster.prev_last7_raw[s]),
+               tuple(frozenset(dom) for dom in cell_dom[s]))
+        classes.setdefault(key, []).append(s)
+    return [members for members in classes.values() if len(members) >= 2]
+
+def _shift_code(s, d):
+    return sum(k * X[s, d, k] for k in np.flatnonzero(dom_mask[s, d]).tolist())
+
+def add_lex_leq(s1, s2):
+    """Row s1 ≤ row s2 lexicographically; eq is 'rows equal on all days so far'."""
+    eq = 1
+    for d in range(NUM_DAYS):
+        a, b = _shift_code(s1, d), _shift_code(s2, d)
+        if isinstance(eq, int):
+            model.Add(a <= b)
+        else:
+            model.Add(a <= b).OnlyEnforceIf(eq)
+        if d == NUM_DAYS - 1:
+            break
+        same = model.NewBoolVar(f"lex_same_{s1}_{s2}_{d}")
+        model.Add(a >= b).OnlyEnforceIf(same)
+        model.Add(a < b).OnlyEnforceIf(same.Not())
+        eq = all_of([eq, same], f"lex_eq_{s1}_{s2}_{d}")
+
+if args.symmetry_breaking:
+    sym_classes = interchangeable_classes()
+    for members in sym_classes:
+        for s1, s2 in zip(members, members[1:]):
+            add_lex_leq(s1, s2)
+    print(f"➡️  Symmetry breaking: {len(sym_classes)} class(es) of interchangeable staff "
+          f"({', '.join('/'.join(staff[s] for s in m) for m in sym_classes) or 'none'})")
+
+registry.finalize()
+if args.model_stats:
+    registry.report()
+
+# === Warm-start hints (--hint) ===
+# A roster grid (last run's Roster_Output1.xlsx / .json, or a draft typed into a copy of the input
+# sheet) becomes the solver's solution hint: each cell's code sets the cell's X literals (1 for
+# that shift, 0 for the other shifts the cell allows). Staff rows are matched by name, days by
+# position. A code the cell no longer allows (an edited request, a fixed-only code, a zero night
+# quota, ...) leaves the cell unhinted; see complete_hint() for hints that break the other hard
+# rules.
+def read_hint_grid(path):
+    """{staff name: [code per day]} from an Output1 .json or a roster sheet (.xlsx)."""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return {st["name"]: st["roster"] for st in json.load(f)["staff"]}
+    wb = load_workbook(path, read_only=True, data_only=True)
+    ws = wb[SHEET_NAME] if SHEET_NAME in wb.sheetnames else wb.active
+    rows = [list(r) for r in ws.iter_rows(values_only=True)]
+    wb.close()
+    start = find_anchor(build_anchor_index(rows), "START")[1]   # day d is 0-based column start + d
+    grid = {}
+    for row in rows[ROW_START - 1:]:
+        if len(row) < 4 or not row[3]:
+            break
+        grid[str(row[3]).strip()] = row[start:start + NUM_DAYS]
+    return grid
+
+def add_roster_hint(grid):
+    """Hint X from the grid; returns HINT[s, d] (the hinted shift code, -1 = no hint)."""
+    hint = np.full((NUM_STAFF, NUM_DAYS), -1, dtype=np.int64)
+    unknown = 0
+    for s, name in enumerate(staff):
+        for d, v in enumerate(list(grid.get(name) or [])[:NUM_DAYS]):
+            code = str(v or "").strip().rstrip("↗").strip()   # "N*" is a code, "P*" an IC-marked P
+            k = SHIFT_CODE.get(code, SHIFT_CODE.get(_norm(code), -1))
+            unknown += k < 0 and not _blank(v)
+            hint[s, d] = k
+    ok = (hint >= 0) & np.take_along_axis(dom_mask, np.maximum(hint, 0)[:, :, None], axis=2)[:, :, 0]
+    stale = int(((hint >= 0) & ~ok).sum())
+    allowed = ok & (dom_size > 1)      # fixed cells need no hint
+    hint[~allowed] = -1
+    idx = XI[allowed]
+    val = np.arange(len(SHIFTS)) == hint[allowed][:, None]
+    sol_hint = model.Proto().solution_hint
+    sol_hint.vars.extend(idx[idx >= 0].tolist())
+    sol_hint.values.extend(val[idx >= 0].astype(np.int64).tolist())
+    missing = sum(name not in grid for name in staff)
+    print(f"➡️  Hints: {int(allowed.sum())} cells from {args.hint} "
+          f"({stale} not allowed any more, {unknown} unknown codes, "
+          f"{missing} staff not in the grid)")
+    return hint
+
+HINT = add_roster_hint(read_hint_grid(args.hint)) if args.hint else None
+
+# === Solver parameters ===
+# defaults < preset < sheet cells (SOLVER_CELLS: F3 time limit, G3 workers, H3 seed, F4 relative
+# gap, G4 preset) < command line. Workers default to one per CPU core, so CP-SAT runs its full
+# parallel portfolio; a blank seed draws a random one. The effective values are printed and
+# written into Output1, so a run can be repeated with the same parameters.
+SOLVER_PRESETS = {   # name -> CP-SAT parameters
+    "default":     {},
+    "quick":       {"max_time_in_seconds": 60, "relative_gap_limit": 0.05},   # a good roster, soon
+    "feasibility": {"stop_after_first_solution": True},                      # the first valid roster
+    "thorough":    {"max_time_in_seconds": 1800, "linearization_level": 2},  # final optimisation run
+}
+SOLVER_PARAMS = {   # setting -> (CP-SAT parameter, type)
+    "time_limit":   ("max_time_in_seconds", float),
+    "workers":      ("num_workers", int),
+    "seed":         ("random_seed", int),
+    "relative_gap": ("relative_gap_limit", float),
+}
 
+def solver_settings():
+    """(preset name, CP-SAT parameters) from the sheet cells, the command line and the defaults."""
+    raw = {k: roster.settings.get(k) for k in SOLVER_CELLS}
+    raw.update({k: getattr(args, k) for k in SOLVER_CELLS if getattr(args, k) is not None})
+    preset = str(raw["preset"] or "default").strip().lower()
+    if preset not in SOLVER_PRESETS:
+        raise ValueError(f"❌ Unknown solver preset {raw['preset']!r} (use {', '.join(SOLVER_PRESETS)})")
+    params = dict(SOLVER_PRESETS[preset])
+    for key, (param, typ) in SOLVER_PARAMS.items():
+        if _blank(raw[key]):
+            continue
+        try:
+            params[param] = typ(float(raw[key]))
+        except (TypeError, ValueError):
+            raise ValueError(f"❌ Solver setting {key}: {raw[key]!r} is not a number")
+    params.setdefault("max_time_in_seconds", 300)
+    params.setdefault("relative_gap_limit", 0.0)
+    params.setdefault("random_seed", random.randrange(1, 10000))
+    if not params.get("num_workers"):
+        params["num_workers"] = os.cpu_count() or 1
+    return preset, params
+
+solver_preset, solver_params = solver_settings()
+SOLVER_USED = {"preset": solver_preset}   # setting -> effective value, for Output1
+SOLVER_USED.update({key: solver_params[param] for key, (param, _) in SOLVER_PARAMS.items()})
+print(f"➡️  Solver: preset {solver_preset}, {SOLVER_USED['time_limit']:g} s, {SOLVER_USED['workers']} worker(s), "
+      f"seed {SOLVER_USED['seed']}, relative gap {SOLVER_USED['relative_gap']:g}")
+
+# === Solved roster → Output1 ===
+# Shared by the final Output1 and the --snapshot incumbents. A solution is read as `values`, the
+# full CP-SAT solution vector, and `value`, which evaluates a model expression in it.
+
+def pattern_counts(cls):
+    """(PA, PAN, PPP) arrays over staff from the class bits cls[s, d] of solved rows, counted on
+    the last day of each pattern like the detectors; last month's tail supplies the days before day 0."""
+    full = np.concatenate([PREV_CLS, cls], axis=1)
+    am, pm, nt = ((full & c) != 0 for c in (CLS_AM, CLS_PM, CLS_NIGHT))
+    pa  = (pm[:, 6:-1] & am[:, 7:]).sum(axis=1)
+    pan = (pm[:, 5:-2] & am[:, 6:-1] & nt[:, 7:]).sum(axis=1)
+    ppp = (pm[:, 5:-2] & pm[:, 6:-1] & pm[:, 7:]).sum(axis=1)
+    return pa, pan, ppp
+
+def solved_roster(values):
+    """(ASSIGN, ASSIGN_CLS, out_grid) of a solution vector: ASSIGN[s, d] is the solved shift code,
+    ASSIGN_CLS[s, d] its class bits, out_grid one code per cell (prefilled requests keep their ↗)."""
+    sol = np.where(XI >= 0, values[np.maximum(XI, 0)], XV)   # sol[s, d, k] = value of X[s, d, k]
+    assign = sol.argmax(axis=2)
+    grid = [[SHIFTS[k] for k in row] for row in assign.tolist()]
+    for (s, d), raw in fixed_raw.items():
+        if raw.endswith("↗"):
+            grid[s][d] += "↗"
+    return assign, SHIFT_CLASS[assign], grid
+
+# Per-staff statistics, in the column order of the "Output" block
+OUTPUT_STATS = ("Sun Off", "WE Off", "Sun P", "P/A ratio", "duty hr", "final hr", "PA", "PAN", "PPP")
+is_sun = np.array([wd == "SUN" for wd in weekdays])
+is_we  = np.array([t == "WE" for t in day_type])
+
+def staff_statistics(assign, assign_cls, value):
+    """One {OUTPUT_STATS key: value} dict per staff row of a solved roster."""
+    solved_off = (assign_cls & CLS_OFF) != 0
+    pm_counts  = ((assign_cls & CLS_PM) != 0).sum(axis=1)
+    am_counts  = ((assign_cls & CLS_AM) != 0).sum(axis=1)
+    pa_counts, pan_counts, ppp_counts = pattern_counts(assign_cls)
+    stats = []
+    for s, name in enumerate(staff):
+        # --- compute star hours from the grid (prefilled/converted ☆) ---
+        star_count = int((assign[s] == SHIFT_CODE["☆"]).sum())
+        star_hours = 0 * star_count
+
+        # --- duty hours & final hr (solver vars exclude prefilled; add star-hours) ---
+        duty_hours  = value(hour_assigned[s]) + star_hours
+        final_hours = value(final_hr[s]) + star_hours
+
+        # --- P/A ratio from the solved grid ---
+        pm_count, am_count = int(pm_counts[s]), int(am_counts[s])
+        pa_ratio = (pm_count / am_count) if am_count else 0.0
+
+        # --- Sun Off & WE Off counts (any OFF-type: OFF class) ---
+        sun_off_count = (solved_off[s] & is_sun).sum()
+        we_off_count  = (solved_off[s] & is_we).sum()
+
+        # --- Sun-P count ---
+        sun_p_count = ((assign[s] == SH_P) & is_sun).sum()
+
+        # --- Pattern counts from the solved row ---
+        # PA (PM→AM), PAN (PM→AM→Night), PPP (3×PM)
+        pa_cnt, pan_cnt, ppp_cnt = pa_counts[s], pan_counts[s], ppp_counts[s]
+
+        stats.append(dict(zip(OUTPUT_STATS, (
+            int(sun_off_count), int(we_off_count), int(sun_p_count), round(pa_ratio, 2),
+            int(duty_hours), int(final_hours), int(pa_cnt), int(pan_cnt), int(ppp_cnt)))))
+    return stats
+
+def hour_spread_of(value):
+    """Achieved hour-balance spread among staff without a personal range (capped by O2 threshold)."""
+    if len(eligible_for_pairwise) < 2:
+        return None
+    fh = [value(final_hr[s]) for s in eligible_for_pairwise]
+    return max(fh) - min(fh)
+
+def output1_json(grid, stats, hour_spread):
+    """Output1 for structured input: the roster and statistics as one JSON document."""
+    return {
+        "month": None if month is None else str(month),
+        "dates": dates, "weekdays": weekdays, "hour_spread": hour_spread, "solver": SOLVER_USED,
+        "staff": [{"name": name, "rank": ranks[s], "roster": grid[s], "stats": stats[s]}
+                  for s, name in enumerate(staff)],
+    }
 
-# --- Weekly PM cap: ≤4 per staff per 7-day block starting from first Sunday ---
+def output1_template():
+    """The input workbook (with its formulas) as the template for Output1."""
+    wb_roster = load_workbook(INPUT_ROSTER)
+    ws_roster = wb_roster[SHEET_NAME]
+
+    # initial hour balance: replace the formula in column O by its value
+    for s, name in enumerate(staff):
+        ws_roster.cell(row=ROW_START + s, column=15, value=quotas[name]["init_hr"])
+
+    # effective solver settings, into their own cells next to D3 / D4
+    for key, (r, c) in SOLVER_CELLS.items():
+        ws_roster.cell(row=r, column=c).value = SOLVER_USED[key]
+    return wb_roster
+
+def write_output1_xlsx(path, grid, stats, wb_roster=None):
+    """Output1 for Excel input: the input sheet (with its formulas) carrying the solved grid, the
+    statistics under the "Output" anchor and the effective solver settings. wb_roster: a template
+    from output1_template() to write into (and reuse), else one is loaded."""
+    if wb_roster is None:
+        wb_roster = output1_template()
+    ws_roster = wb_roster[SHEET_NAME]
+
+    # write back
+    grey = PatternFill("solid", fgColor="C0C0C0")
+    red  = Font(color="FF0000")
+    for s in range(NUM_STAFF):
+        for d in range(NUM_DAYS):
+            cell = ws_roster.cell(row=ROW_START+s, column=START_COL+d)
+            cell.value = grid[s][d]
+            if (s,d) in fixed_raw:
+                cell.fill = grey
+            if day_type[d]=="WE":
+                cell.font = red
+
+    # === Combined writeback anchored at "Output" ===
+    # Locate the anchor column for the metrics (same sheet layout as the parsed input)
+    OUTPUT_COL = find_anchor(roster.anchors, "OUTPUT")[1]
+
+    for s, name in enumerate(staff):
+        row = ROW_START + s
+        # Write in required sequence starting from OUTPUT_COL:
+        # Sun Off, WE Off, Sun P, P/A ratio, duty hr, final hr, PA, PAN, PPP (3×PM)
+        for k, key in enumerate(OUTPUT_STATS):
+            ws_roster.cell(row=row, column=OUTPUT_COL + k).value = stats[s][key]
+    wb_roster.save(path)
+
+# === Incumbent snapshots (--snapshot) ===
+# With penalties on, CP-SAT improves the roster until the time limit. SnapshotWriter writes each
+# improving roster to the --snapshot file (.xlsx: a provisional Output1; .json: Output1 as JSON
+# plus the objective and its PA / PAN / PPP breakdown), so a run can be stopped as soon as the
+# roster is good enough. Writes are at most one per --snapshot-every seconds: an improvement
+# inside that gap is kept and written by the next callback past the gap, or by flush() once the
+# solve returns. Writes go through a temporary file, so an interrupted run never leaves a
+# half-written snapshot; the .xlsx template is loaded once, not on every write.
+class SnapshotWriter(cp_model.CpSolverSolutionCallback):
+    def __init__(self, path, every):
+        super().__init__()
+        self.path, self.every = path, every
+        self.solutions = 0
+        self.last_write = None   # solver wall time of the last write
+        self.pending = None      # (solution no., wall time, values, objective, bound) not yet written
+        self.template = None if path.lower().endswith(".json") else output1_template()
+
+    def on_solution_callback(self):
+        self.solutions += 1
+        now = self.WallTime()
+        self.pending = (self.solutions, now, np.array(self.response_proto.solution, dtype=np.int64),
+                        self.ObjectiveValue(), self.BestObjectiveBound())
+        if self.last_write is None or now - self.last_write >= self.every:
+            self.flush()
+
+    def flush(self):
+        """Write the kept incumbent, if any."""
+        if self.pending is None:
+            return
+        n, now, values, objective, bound = self.pending
+        self.pending = None
+        self.last_write = now
+        value = lambda e: e if isinstance(e, int) else int(values[e.Index()])
+        assign, assign_cls, grid = solved_roster(values)
+        stats = staff_statistics(assign, assign_cls, value)
+        totals = {key: sum(st[key] for st in stats) for key in ("PA", "PAN", "PPP")}
+        tmp = self.path + ".part"
+        if self.template is None:
+            doc = output1_json(grid, stats, hour_spread_of(value))
+            doc["incumbent"] = {"solution": n, "wall_time": round(now, 1),
+                                "objective": objective, "bound": bound,
+                                "penalties": {key: {"count": c, "weight": W}
+                                              for (key, c), W in zip(totals.items(), (W_PA, W_PAN, W_3PM))}}
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(doc, f, ensure_ascii=False, indent=1)
+        else:
+            write_output1_xlsx(tmp, grid, stats, self.template)
+        os.replace(tmp, self.path)
+        print(f"➡️  Snapshot {n} at {now:.0f} s: objective {objective:g} "
+              f"(PA {totals['PA']}, PAN {totals['PAN']}, PPP {totals['PPP']}) → {self.path}")
 
-# 1) Find the index of the first Sunday
-first_sun = next((i for i, wd in enumerate(weekdays) if wd == "SUN"), 0)
+snapshot = None
+if args.snapshot:
+    if not (args.snapshot.lower().endswith(".json") or INPUT_IS_EXCEL):
+        raise ValueError(f"❌ --snapshot {args.snapshot}: an .xlsx snapshot needs an Excel input (use .json)")
+    snapshot = SnapshotWriter(args.snapshot, args.snapshot_every)
 
-# 2) For each staff, slide a 7-day window starting at first_sun, then every 7 days
-for s in range(NUM_STAFF):
-    for wk_start in range(first_sun, NUM_DAYS, 7):
-        wk_end = min(wk_start + 7, NUM_DAYS)
-        model.Add(
-            sum(X[s, d, "P"] for d in range(wk_start, wk_end))
-            <= 4
-        )
-            
 # solve
 
 solver = cp_model.CpSolver()
-solver.parameters.max_time_in_seconds = 300
-solver.parameters.random_seed = random.randrange(1,10000)
-res = solver.Solve(model)
+for param, value in solver_params.items():
+    setattr(solver.parameters, param, value)
+solver.parameters.log_search_progress = args.solver_log
+
+# === Infeasibility diagnosis (--diagnose) ===
+# Every rule constraint gets a guard literal, one per rule family and staff row (a constraint on
+# one person), per family and day (several staff within a week, e.g. coverage or senior mix on a
+# day) or per family. Variable definitions, one shift/day and the cell domains (requests, fixed
+# rows, last month's tail) stay hard. The guards are solved as assumptions: an infeasible model
+# comes back with SufficientAssumptionsForInfeasibility(), which is then shrunk by dropping one
+# guard at a time while the rest stay infeasible, so every rule left in the report is needed.
+DIAGNOSIS_HARD = {"decision vars", "day counters", "one shift/day", "pattern detectors"}
+GUARDABLE = ("linear", "bool_and", "bool_or")   # constraint kinds CP-SAT can enforce
+
+def _ct_vars(ct):
+    kind = ct.WhichOneof("constraint")
+    refs = list(ct.linear.vars) if kind == "linear" else list(getattr(ct, kind).literals) if kind in GUARDABLE else []
+    return [r if r >= 0 else -r - 1 for r in refs + list(ct.enforcement_literal)]
+
+def constraint_scopes():
+    """(staff, first day, last day) per model variable: -1 staff = unknown, -2 = several. Starts from
+    the X cells and follows the definitions and equalities to the variables built on them."""
+    proto = model.Proto()
+    owner = np.full(len(proto.variables), -1, dtype=np.int64)
+    first = np.full(len(proto.variables), NUM_DAYS, dtype=np.int64)
+    last = np.full(len(proto.variables), -1, dtype=np.int64)
+    cells = np.argwhere(x_free)
+    owner[XI[x_free]], first[XI[x_free]], last[XI[x_free]] = cells[:, 0], cells[:, 1], cells[:, 1]
+    fixed = {i for i, v in enumerate(proto.variables) if len(v.domain) == 2 and v.domain[0] == v.domain[1]}
+    links = []
+    for i, ct in enumerate(proto.constraints):
+        is_def = i >= len(registry.tags) or registry.tags[i][1]
+        is_eq = ct.WhichOneof("constraint") == "linear" and len(ct.linear.domain) == 2 \
+            and ct.linear.domain[0] == ct.linear.domain[1]
+        if is_def or is_eq:
+            links.append([v for v in _ct_vars(ct) if v not in fixed])
+    changed = True
+    while changed:
+        changed = False
+        for vs in links:
+            known = [v for v in vs if owner[v] != -1]
+            unknown = [v for v in vs if owner[v] == -1]
+            if not known or not unknown:
+                continue
+            who = set(owner[known].tolist())
+            owner[unknown] = who.pop() if len(who) == 1 else -2
+            first[unknown], last[unknown] = first[known].min(), last[known].max()
+            changed = True
+    return owner, first, last, fixed
+
+def add_guards():
+    """Guard every rule constraint; returns {guard variable index: label}."""
+    proto = model.Proto()
+    owner, first, last, fixed = constraint_scopes()
+    guards = {}   # group key -> (guard index, label)
+    for i, ct in enumerate(proto.constraints[:len(registry.tags)]):
+        family, is_def = registry.tags[i]
+        if is_def or family in DIAGNOSIS_HARD or ct.WhichOneof("constraint") not in GUARDABLE:
+            continue
+        vs = [v for v in _ct_vars(ct) if v not in fixed]
+        who = set(owner[vs].tolist()) - {-1}
+        days = [d for v in vs if last[v] >= 0 for d in (first[v], last[v])]
+        if len(who) == 1 and -2 not in who:
+            s = who.pop()
+            key, label = (family, "staff", s), f"{family} of {staff[s]}"
+        elif days and max(days) - min(days) < 7:
+            a, b = int(min(days)), int(max(days))
+            key = (family, "day", a, b)
+            label = f"{family} on {day_label(a)}" + (f" – {day_label(b)}" if b > a else "")
+        else:
+            key, label = (family,), family
+        if key not in guards:
+            guards[key] = (len(proto.variables), label)
+            proto.variables.add(name=f"guard: {label}", domain=(0, 1))
+        ct.enforcement_literal.append(guards[key][0])
+    return dict(guards.values())
+
+def diagnose_infeasibility():
+    """Solve with every rule guarded; print a minimal set of conflicting rules. Exits."""
+    proto = model.Proto()
+    proto.ClearField("objective")
+    proto.ClearField("solution_hint")
+    labels = add_guards()
+    handles = dict(zip(labels, bulk.wrap(list(labels))))
+    sub = cp_model.CpSolver()
+    sub.parameters.CopyFrom(solver.parameters)
+    sub.parameters.num_workers = 1   # the core comes from the single-thread search
+    print(f"➡️  Diagnosis: {len(labels)} guarded rule groups")
+
+    def solve_with(core):
+        model.ClearAssumptions()
+        model.AddAssumptions([handles[g] for g in core])
+        return sub.Solve(model)
+
+    res = solve_with(labels)
+    if res in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        print("✅ Diagnosis: the rules fit together; a roster exists (run without --diagnose)")
+        sys.exit(0)
+    if res != cp_model.INFEASIBLE:
+        print(f"⚠️  Diagnosis: no answer within {sub.parameters.max_time_in_seconds:g} s (raise --time-limit)")
+        sys.exit(1)
+    core = list(sub.SufficientAssumptionsForInfeasibility())
+    # drop one guard at a time; whatever stays infeasible without it was not needed
+    sub.parameters.max_time_in_seconds = min(solver.parameters.max_time_in_seconds / 10, 30.0)
+    undecided = 0
+    for g in list(core):
+        if g not in core:
+            continue
+        rest = [h for h in core if h != g]
+        res = solve_with(rest)
+        if res == cp_model.INFEASIBLE:
+            smaller = set(sub.SufficientAssumptionsForInfeasibility())
+            core = [h for h in rest if h in smaller] if smaller else rest
+        elif res != cp_model.FEASIBLE and res != cp_model.OPTIMAL:
+            undecided += 1
+    model.ClearAssumptions()
+    if not core:
+        print("❌ Diagnosis: the requests, fixed rows and last month's duties conflict on their own "
+              "(run without --no-precheck for details)")
+        sys.exit(1)
+    print(f"❌ No roster: these {len(core)} rule(s) cannot all hold" +
+          (f" (not proven minimal: {undecided} check(s) timed out)" if undecided else "") +
+          "; relaxing any one of them removes this conflict:")
+    for g in sorted(core, key=lambda g: labels[g]):
+        print(f"   • {labels[g]}")
+    sys.exit(1)
+
+if args.diagnose:
+    diagnose_infeasibility()
+
+# A hint on X alone leaves the counters, hour sums and detectors unhinted, and CP-SAT follows such
+# a partial hint only loosely. Completing it first, by solving a copy of the model with the hinted
+# cells fixed, hands the main search a full, feasible starting roster. A hint of the whole roster
+# leaves little more than propagation; a partial draft has its unhinted cells searched (at most
+# 60 s). If the hinted cells break a hard rule, --hint-repair solves the copy for the roster that
+# changes the fewest hinted cells instead (at most 30 s more). Both come out of the time limit.
+def complete_hint():
+    """Full solution hint (one value per model variable) from the cell hint, or None."""
+    cells = model.Proto().solution_hint
+    trial = cp_model.CpModel()
+    trial.Proto().CopyFrom(model.Proto())
+    trial.Proto().ClearField("objective")
+    for v, x in zip(cells.vars, cells.values):
+        trial.Proto().variables[v].domain[:] = [x, x]
+    sub = cp_model.CpSolver()
+    sub.parameters.CopyFrom(solver.parameters)
+    sub.parameters.max_time_in_seconds = min(solver.parameters.max_time_in_seconds, 60.0)
+    res = sub.Solve(trial)
+    spent = sub.WallTime()
+    if res not in (cp_model.OPTIMAL, cp_model.FEASIBLE) and args.hint_repair:
+        print("⚠️  Hinted cells break a hard rule; repairing the hint")
+        trial.Proto().CopyFrom(model.Proto())
+        trial.Proto().ClearField("objective")
+        ones = [v for v, x in zip(cells.vars, cells.values) if x]
+        trial.Proto().objective.vars.extend(ones)
+        trial.Proto().objective.coeffs.extend([-1] * len(ones))   # keep as many hinted shifts as possible
+        left = max(solver.parameters.max_time_in_seconds - spent, 1.0)
+        sub.parameters.max_time_in_seconds = min(solver.parameters.max_time_in_seconds / 10, 30.0, left)
+        sub.parameters.repair_hint = True
+        res = sub.Solve(trial)
+        spent += sub.WallTime()
+    solver.parameters.max_time_in_seconds = max(solver.parameters.max_time_in_seconds - spent, 1.0)
+    if res not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        print("⚠️  Hinted cells break a hard rule; keeping them as a partial hint"
+              + ("" if args.hint_repair else " (--hint-repair repairs them)"))
+        return None
+    return sub.ResponseProto().solution
+
+if HINT is not None and len(model.Proto().solution_hint.vars):
+    full = complete_hint()
+    if full is not None:
+        model.Proto().ClearField("solution_hint")
+        model.Proto().solution_hint.vars.extend(range(len(full)))
+        model.Proto().solution_hint.values.extend(full)
+
+# Two-phase solve (--two-phase): the model is built once. Phase 1 drops the penalty objective and
+# stops at the first valid roster (within --phase1-time); phase 2 restores the objective, hints the
+# phase-1 solution and bounds the penalty by its value, so the search only looks for better
+# rosters. It spends the rest of the time limit. If phase 1 proves there is no roster the run stops
+# there; if it runs out of time, phase 2 is a plain solve.
+def solve_feasibility_first():
+    """Phase 1 of --two-phase; on success the model carries its solution as hint and bound."""
+    model.Minimize(0)
+    first = cp_model.CpSolver()
+    first.parameters.CopyFrom(solver.parameters)
+    first.parameters.max_time_in_seconds = min(args.phase1_time, solver.parameters.max_time_in_seconds)
+    res = first.Solve(model)
+    model.Minimize(PENALTY)
+    spent = first.WallTime()
+    solver.parameters.max_time_in_seconds = max(solver.parameters.max_time_in_seconds - spent, 1.0)
+    if res == cp_model.INFEASIBLE:
+        print("❌ No feasible solution. Run with --diagnose to find the conflicting rules.")
+        exit(1)
+    if res not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        print(f"⚠️  Phase 1: no roster within {first.parameters.max_time_in_seconds:g} s; "
+              f"minimising the penalties from scratch")
+        return
+    bound = int(first.Value(PENALTY))
+    print(f"➡️  Phase 1: valid roster in {spent:.1f} s, penalty {bound}")
+    model.Proto().ClearField("solution_hint")
+    model.Proto().solution_hint.vars.extend(range(len(model.Proto().variables)))
+    model.Proto().solution_hint.values.extend(first.ResponseProto().solution)
+    model.Add(PENALTY <= bound)
+
+if args.two_phase and PENALTY is not None:
+    solve_feasibility_first()
+res = solver.Solve(model, snapshot)
+if snapshot is not None:
+    snapshot.flush()   # an improvement that came inside the last --snapshot-every gap
 if res not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-    print("❌ No feasible solution.")
+    print("❌ No feasible solution." + (" Run with --diagnose to find the conflicting rules."
+                                        if res == cp_model.INFEASIBLE else ""))
     exit(1)
 
     
 # === PART3. Diagnostics & Output ===
 
-    
-# write back
-grey = PatternFill("solid", fgColor="C0C0C0")
-red  = Font(color="FF0000")
-for s in range(NUM_STAFF):
-    for d in range(NUM_DAYS):
-        cell = ws_roster.cell(row=ROW_START+s, column=START_COL+d)
-        if (s,d) in fixed_raw:
-            orig  = fixed_raw[(s,d)]
-            arrow = orig.endswith("↗")
-            for t in SHIFTS:
-                if solver.Value(X[s,d,t]):
-                    cell.value = t + ("↗" if arrow else "")
-                    break
-            cell.fill = grey
-        else:
-            for t in SHIFTS:
-                if solver.Value(X[s,d,t]):
-                    cell.value = t
-                    break
-        if day_type[d]=="WE":
-            cell.font = red
-# === Combined writeback anchored at "Output" ===
-
-def _core(v):
-    return str(v or "").rstrip("↗").strip()
+# Solved values, read from the response in one pass
+values = np.asarray(solver.ResponseProto().solution, dtype=np.int64)
+ASSIGN, ASSIGN_CLS, out_grid = solved_roster(values)
 
-def _find_output_col(ws, max_rows=10):
-    for r in range(1, min(ws.max_row, max_rows) + 1):
-        for c in range(1, ws.max_column + 1):
-            val = str(ws.cell(r, c).value or "").strip().lower()
-            if val == "output":
-                return c
-    raise RuntimeError('Could not find a cell with text "Output" in the first rows.')
-
-# Locate the anchor column for the metrics
-OUTPUT_COL = _find_output_col(ws_roster)
-
-for s, name in enumerate(staff):
-    row = ROW_START + s
-
-    # --- compute star hours from the sheet (prefilled/converted ☆) ---
-    star_count = sum(
-        1
-        for d in range(NUM_DAYS)
-        if _core(ws_roster.cell(row=row, column=START_COL + d).value) == "☆"
-    )
-    star_hours = 0 * star_count
+if HINT is not None and (HINT >= 0).any():
+    kept = int((ASSIGN == HINT)[HINT >= 0].sum())
+    print(f"➡️  Hints kept: {kept} of {int((HINT >= 0).sum())} cells ({kept / (HINT >= 0).sum():.0%})")
 
-    # --- duty hours & final hr (solver vars exclude prefilled; add star-hours) ---
-    duty_hours  = solver.Value(hour_assigned[s]) + star_hours
-    final_hours = solver.Value(final_hr[s]) + star_hours
+staff_stats = staff_statistics(ASSIGN, ASSIGN_CLS, solver.Value)
 
-    # --- P/A ratio from what’s actually written in the grid (post-solve values) ---
-    pm_count = 0
-    am_count = 0
-    for d in range(NUM_DAYS):
-        val = str(ws_roster.cell(row=row, column=START_COL + d).value or "")
-        shift = val.rstrip("↗")
-        if shift in PM_SH:
-            pm_count += 1
-        if shift in AM_SH:
-            am_count += 1
-    pa_ratio = (pm_count / am_count) if am_count else 0.0
-
-    # --- Sun Off & WE Off counts (any OFF-type: OFF set) ---
-    sun_off_count = sum(
-        1
-        for d, wd in enumerate(weekdays)
-        if wd == "SUN" and _core(ws_roster.cell(row=row, column=START_COL + d).value) in OFF
-    )
-    we_off_count = sum(
-        1
-        for d in range(NUM_DAYS)
-        if day_type[d] == "WE" and _core(ws_roster.cell(row=row, column=START_COL + d).value) in OFF
-    )
+hour_spread = hour_spread_of(solver.Value)
+if hour_spread is not None:
+    print(f"➡️  Hour spread: {hour_spread} h over {len(eligible_for_pairwise)} staff (threshold {threshold} h)")
 
-    # --- Sun-P count ---
-    sun_p_count = sum(
-        1
-        for d in range(NUM_DAYS)
-        if weekdays[d] == "SUN"
-        and str(ws_roster.cell(row=row, column=START_COL + d).value or "").rstrip("↗") == "P"
-    )
+if not INPUT_IS_EXCEL:
+    # Structured input: write the roster and statistics as JSON.
+    # Post-processing (Output2/Output3) works on the Excel layout only.
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        json.dump(output1_json(out_grid, staff_stats, hour_spread), f, ensure_ascii=False, indent=1)
+    print(f"✅ Written {OUTPUT_FILE}")
+    sys.exit(0)
 
-    # --- Penalty counts from detector variables ---
-    # PA (PM→AM), PAN (PM→AM→Night), PPP (3×PM)
-    pa_cnt  = sum(solver.Value(v) for v in pm_am        if f"_{s}_" in v.Name())
-    pan_cnt = sum(solver.Value(v) for v in pm_am_night  if f"_{s}_" in v.Name())
-    ppp_cnt = sum(solver.Value(v) for v in three_pm     if f"_{s}_" in v.Name())
-
-    # --- Write in required sequence starting from OUTPUT_COL ---
-    col = OUTPUT_COL
-    ws_roster.cell(row=row, column=col + 0).value = int(sun_off_count)       # Sun Off
-    ws_roster.cell(row=row, column=col + 1).value = int(we_off_count)        # WE Off
-    ws_roster.cell(row=row, column=col + 2).value = int(sun_p_count)         # Sun P
-    ws_roster.cell(row=row, column=col + 3).value = round(pa_ratio, 2)       # P/A ratio
-    ws_roster.cell(row=row, column=col + 4).value = int(duty_hours)          # duty hr
-    ws_roster.cell(row=row, column=col + 5).value = int(final_hours)         # final hr
-    ws_roster.cell(row=row, column=col + 6).value = int(pa_cnt)              # PA count
-    ws_roster.cell(row=row, column=col + 7).value = int(pan_cnt)             # PAN count
-    ws_roster.cell(row=row, column=col + 8).value = int(ppp_cnt)             # PPP (3×PM) count
-# now save
-wb_roster.save(OUTPUT_FILE)
+write_output1_xlsx(OUTPUT_FILE, out_grid, staff_stats)
 print(f"✅ Written {OUTPUT_FILE}")
 
 
@@ -1396,8 +2697,6 @@ print(f"✅ Written {OUTPUT_FILE}")
 ####PART4####
 
 # === Post‐hoc conversion block (fixed arrow handling) ===
-from openpyxl import load_workbook
-import random
 
 wb2 = load_workbook("Roster_Output1.xlsx")
 ws2 = wb2["Sheet1"]
@@ -1422,11 +2721,9 @@ if toggle_val >1:
             return s[:-1], "↗"
         return s, ""
     
-    # find START column
-    c = 1
-    while str(ws2.cell(1, c).value or "").strip().upper() != "START":
-        c += 1
-    START = c + 1
+    # find START column (and the other landmarks) in one sweep
+    anchors2 = sheet_anchors(ws2)
+    START = find_anchor(anchors2, "START")[1] + 1
 
     # classify day‐cols
     day_cols, weekend, weekday = [], set(), []
@@ -1466,18 +2763,11 @@ if toggle_val >1:
                 core, arr = split_arrow(ws2.cell(r,c).value)
                 if core == "Z":
                     ws2.cell(r,c).value = "Z2" + arr
-import random
 
 # === 7) Special duties assignment ===
 
 # 7.1 Find the "Special duties" column (row 4)
-SD = None
-for c in range(1, ws2.max_column + 1):
-    if str(ws2.cell(4, c).value or "").strip().upper() == "SPECIAL DUTIES":
-        SD = c
-        break
-if SD is None:
-    raise RuntimeError("❌ Could not find 'Special duties' column in row 4.")
+SD = find_anchor(anchors2, "SPECIAL DUTIES")[1]
 
 # 7.2 Read staff tiers from the SD column
 tiers = {}
@@ -2452,7 +3742,6 @@ if toggle_val < 3:
     exit(0)   # clean exit
 
 from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
 
 SRC_FILE = "Roster_Output2.xlsx"   # source of duties
 SRC_SHEET = "Sheet1"
@@ -2467,28 +3756,6 @@ ws_tgt = wb_tgt[TGT_SHEET]
 OUT_FILE = "Roster_Output3.xlsx"          # output file
 
 # ---------- helpers ----------
-def norm_text(v: object) -> str:
-    s = str(v or "")
-    return " ".join(s.split()).upper()
-
-def find_anchor(ws, needle="NAME OF", max_rows=30, max_cols=100):
-    nd = needle.upper()
-    for r in range(1, min(ws.max_row, max_rows) + 1):
-        for c in range(1, min(ws.max_column, max_cols) + 1):
-            txt = norm_text(ws.cell(r, c).value)
-            if nd in txt:
-                return r, c
-    raise RuntimeError(f'Could not find anchor containing "{needle}" '
-                       f'(searched {max_rows}×{max_cols}).')
-
-def find_start_col(ws):
-    c = 1
-    while c <= ws.max_column:
-        if norm_text(ws.cell(1, c).value) == "START":
-            return c + 1
-        c += 1
-    raise RuntimeError('Could not find "START" in row 1.')
-
 def list_day_cols(ws, start_col):
     cols = []
     c = start_col
@@ -2522,7 +3789,7 @@ ws_src = wb_src[SRC_SHEET]
 print("➡️  Proceeding with write_excel block...")
 
 # 1) Build {doctor -> [duties]}
-src_start_col = find_start_col(ws_src)
+src_start_col = find_anchor(sheet_anchors(ws_src), "START")[1] + 1
 src_day_cols = list_day_cols(ws_src, src_start_col)
 
 SRC_NAME_COL = 4
@@ -2543,7 +3810,7 @@ num_days = len(src_day_cols)
 wb_tgt = load_workbook(TGT_FILE)
 ws_tgt = wb_tgt[TGT_SHEET]
 
-anchor_r, anchor_c = find_anchor(ws_tgt, "Name of")
+anchor_r, anchor_c = find_anchor(sheet_anchors(ws_tgt), "NAME OF")
 name_col = anchor_c + 1
 first_day_col = anchor_c + 2
 first_doc_row = anchor_r + 3